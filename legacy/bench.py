@@ -0,0 +1,207 @@
+
+import sys
+import os
+import json
+import time
+import resource
+import tempfile
+import threading
+import multiprocessing
+import http.server
+import main
+
+# Offline benchmark of the split / chat capture / chapter map / print pipeline on synthetic inputs.
+# Every measurement runs in a forked child, so peak RSS and subprocess counts belong to one stage only.
+# Results go out as JSON lines (stdout or --output), one object per stage and input size.
+
+def usage():
+    main.usage("bench.py [--lengths S,S,..] [--comments N,N,..] [--chapters M,M,..] [--segments N,N,..] [--chunk-size BYTES] [--workdir DIR] [--output FILE]")
+
+def parse_list(args, n):
+    if n >= len(args): main.fatal(f"Expected a list after {args[n - 1]}")
+    if not all(main.isint(i) for i in args[n].split(",")): main.fatal(f"{args[n]} is not a list of numbers")
+    return [int(i) for i in args[n].split(",")]
+
+def parse_args(args):
+    options = {"lengths": [60, 600], "comments": [10_000, 1_000_000], "chapters": [10, 500], "segments": [200],
+               "chunk_size": 50_000_000, "workdir": None, "output": None}
+    n = 1
+    while n < len(args):
+        i = args[n]
+        if i in ("--lengths", "--comments", "--chapters", "--segments"):
+            n += 1
+            options[i[2:]] = parse_list(args, n)
+        elif i == "--chunk-size":
+            n += 1
+            options["chunk_size"] = main.parse_count(args, n)
+        elif i in ("--workdir", "--output"):
+            n += 1
+            if n >= len(args): main.fatal(f"Expected a path after {i}")
+            options[i[2:]] = args[n]
+        else:
+            usage()
+            main.fatal(f"Unknown argument `{i}`")
+        n += 1
+    return options
+
+def make_video(uid, length):
+    if os.path.isfile(f"vods/{uid}.mp4"): return
+    main.log(f"Generating a {main.pretty_time(length)} test video")
+    args = ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={length}",
+            "-f", "lavfi", "-i", f"sine=duration={length}", "-c:v", "libx264", "-preset", "ultrafast", "-b:v", "6M",
+            "-g", 60, "-c:a", "aac", "-shortest", f"vods/{uid}.mp4", "-y"]
+    if main.cmd_silent(args).returncode != 0: main.fatal("ffmpeg couldn't generate the test video")
+
+def make_chat(uid, comments, chapters, length=36_000):
+    # same layout as a ttvdl capture; comments are written one at a time to keep the generator small
+    if os.path.isfile(f"vods/{uid}.json"): return
+    main.log(f"Generating a chat capture with {comments} comments and {chapters} chapters")
+    step = length * 1000 // max(chapters, 1)
+    video = {"title": f"bench {uid}", "id": uid, "created_at": "2024-01-01T12:00:00Z", "start": 0, "end": length, "length": length,
+             "chapters": [{"id": str(i), "startMilliseconds": i * step, "lengthMilliseconds": step, "_type": "GAME_CHANGE",
+                           "description": f"chapter {i}", "subDescription": "", "thumbnailUrl": "", "gameId": str(i),
+                           "gameDisplayName": f"chapter {i}", "gameBoxArtUrl": ""} for i in range(chapters)]}
+    with open(f"vods/{uid}.json", "w", encoding="utf-8") as f:
+        f.write('{"FileInfo": {"Version": {"Major": 1, "Minor": 4, "Patch": 0}}, "streamer": {"name": "bench", "id": 1}, ')
+        f.write('"video": ' + json.dumps(video) + ', "comments": [')
+        for i in range(comments):
+            user = i % 5000
+            comment = {"_id": f"{i:032x}", "created_at": "2024-01-01T12:00:00Z", "channel_id": "1", "content_type": "video",
+                       "content_id": uid, "content_offset_seconds": i * length / max(comments, 1),
+                       "commenter": {"display_name": f"user{user}", "_id": str(user), "name": f"user{user}", "logo": ""},
+                       "message": {"body": f"message number {i} Kappa", "bits_spent": 0,
+                                   "fragments": [{"text": f"message number {i} ", "emoticon": None},
+                                                 {"text": "Kappa", "emoticon": {"emoticon_id": "25"}}],
+                                   "user_badges": [{"_id": "subscriber", "version": "12"}], "user_color": "#FF0000",
+                                   "emoticons": [{"_id": "25", "begin": len(f"message number {i} "), "end": len(f"message number {i} Kappa")}]}}
+            f.write(("," if i else "") + json.dumps(comment))
+        f.write('], "embeddedData": null}')
+
+def make_cat(uid, chapters, length=36_000):
+    with open(f"vods/{uid}.cat", "w", encoding="utf-8") as f:
+        f.write(f"2024-01-01T12:00:00Z bench {uid}\n")
+        for i in range(chapters): f.write(f"{length // max(chapters, 1)} chapter {i}\n")
+
+def drop_caches(uid):
+    for i in (f"vods/{uid}.meta.json", f"vods/{uid}.idx"):
+        if os.path.isfile(i): os.remove(i)
+
+def measure(stage, params, func, *args):
+    def child(pipe):
+        main.trace_records.clear()
+        cpu = time.process_time()
+        start = time.perf_counter()
+        func(*args)
+        wall = time.perf_counter() - start
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        pipe.send({"stage": stage, "params": params, "wall_s": round(wall, 4),
+                   "cpu_s": round(time.process_time() - cpu + children.ru_utime + children.ru_stime, 4),
+                   "subprocesses": sum(1 for i in main.trace_records if i["type"] == "process"), "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   "children_peak_rss_kib": children.ru_maxrss})
+
+    ctx = multiprocessing.get_context("fork")
+    receiver, sender = ctx.Pipe(False)
+    process = ctx.Process(target=child, args=(sender,))
+    process.start()
+    sender.close() # only the child holds the sending end now, so a child that dies leaves EOF behind
+    try: result = receiver.recv()
+    except EOFError: result = None
+    process.join()
+    if process.exitcode != 0 or result is None: main.fatal(f"Stage `{stage}` failed with {params}")
+    main.log(f"{stage} {params}: {result['wall_s']:.3f}s, {result['subprocesses']} subprocesses, peak RSS {main.pretty_bytes(result['peak_rss_kib'] * 1024)}")
+    return result
+
+def print_chapter_map(uid):
+    call = main.cmd_silent([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), "print-chapter-map", uid], capture_output=True)
+    if call.returncode != 0: main.fatal(f"main.py print-chapter-map {uid} failed")
+
+def startup():
+    # `help` does nothing but start up; with no DISPLAY set it also proves the GUI modules aren't imported
+    env = {k: v for k, v in os.environ.items() if k not in ("DISPLAY", "WAYLAND_DISPLAY")}
+    call = main.cmd_silent([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), "help"], capture_output=True, env=env)
+    if call.returncode != 0: main.fatal("main.py help failed without a display")
+
+class SegmentHandler(http.server.BaseHTTPRequestHandler):
+    # a synthetic VOD playlist: 2MB segments after 20ms of latency, every 200th request refused with a 503 and
+    # the -unmuted segments only served as -muted, like Twitch does
+    protocol_version = "HTTP/1.1"
+    segments, requests, lock = 0, 0, threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            SegmentHandler.requests += 1
+            refuse = SegmentHandler.requests % 200 == 0
+        time.sleep(0.02)
+        if self.path == "/index.m3u8":
+            body = "#EXTM3U\n#EXT-X-TARGETDURATION:10\n" + "".join(f"#EXTINF:10.000,\n{i}{'-unmuted' if i % 7 == 3 else ''}.ts\n" for i in range(self.segments))
+            self.reply(200, body.encode() + b"#EXT-X-ENDLIST\n")
+        elif refuse or "-unmuted" in self.path: self.reply(503 if refuse else 403, b"")
+        else: self.reply(200, segment_data(int(self.path[1:].split(".")[0].removesuffix("-muted"))))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+def segment_data(i):
+    return i.to_bytes(4, "little") * (512 * 1024)
+
+def fetch_segments(url, segments):
+    _, playlist = main.parse_m3u8(main.http_text(url), url)
+    main.fetch_hls(playlist, "vods/bench-hls.ts", "vods/bench-hls.hls.json", 2 * 1024 * 1024 * 8 // 10)
+    with open("vods/bench-hls.ts", "rb") as f:
+        if any(f.read(2 * 1024 * 1024) != segment_data(i) for i in range(segments)) or f.read(1): main.fatal("Fetched segments don't match the served ones")
+    for i in ("vods/bench-hls.ts", "vods/bench-hls.hls.json"): os.remove(i)
+
+def run(options):
+    results = [measure("startup", {}, startup)]
+    for length in options["lengths"]:
+        uid = f"bench-video-{length}"
+        make_video(uid, length)
+        params = {"length_s": length, "chunk_size": options["chunk_size"], "source_bytes": os.path.getsize(f"vods/{uid}.mp4")}
+        drop_caches(uid)
+        results.append(measure("split", params, main.split_vod, uid, 1, options["chunk_size"]))
+        results.append(measure("split-cached", params, main.split_vod, uid, 1, options["chunk_size"]))
+
+    for comments in options["comments"]:
+        for chapters in options["chapters"]:
+            uid = f"bench-chat-{comments}-{chapters}"
+            make_chat(uid, comments, chapters)
+            params = {"comments": comments, "chapters": chapters, "capture_bytes": os.path.getsize(f"vods/{uid}.json")}
+            drop_caches(uid)
+            results.append(measure("chat-info", params, lambda: (main.get_name_date_from_cc(uid), main.get_chapters_from_cc(uid))))
+            results.append(measure("chat-info-cached", params, lambda: (main.get_name_date_from_cc(uid), main.get_chapters_from_cc(uid))))
+
+    for chapters in options["chapters"]:
+        uid = f"bench-cat-{chapters}"
+        make_cat(uid, chapters)
+        chunks = [(i * 3600.0, 3600.0) for i in range(10)]
+        params = {"chapters": chapters, "chunks": len(chunks)}
+        results.append(measure("chapter-map", params, lambda: main.generate_chapter_map(uid, chunks, *main.get_name_date_from_cat(uid), main.get_chapters_from_cat(uid))))
+        results.append(measure("print-chapter-map", params, print_chapter_map, uid))
+
+    for segments in options["segments"]:
+        SegmentHandler.segments = segments
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SegmentHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        params = {"segments": segments, "segment_bytes": len(segment_data(0))}
+        results.append(measure("hls", params, fetch_segments, f"http://127.0.0.1:{server.server_port}/index.m3u8", segments))
+        server.shutdown()
+
+    return results
+
+if __name__ == "__main__":
+    options = parse_args(sys.argv)
+    output = os.path.abspath(options["output"]) if options["output"] else None
+    if options["workdir"]: os.makedirs(options["workdir"], exist_ok=True)
+    os.chdir(options["workdir"] or tempfile.mkdtemp(prefix="vodtool-bench-"))
+    main.makedir("vods", True)
+    main.log(f"Benchmarking in {os.getcwd()}")
+
+    results = run(options)
+    lines = "".join(json.dumps(i) + "\n" for i in results)
+    if output: open(output, "w", encoding="utf-8").write(lines)
+    else: sys.stdout.write(lines)
@@ -1,34 +1,123 @@
 
 import sys
-import colorama; colorama.just_fix_windows_console()
 import os
 import subprocess
 import json
+import struct
+import mmap
+import zlib
+import math
+import array
+import re
+import codecs
+import bisect
+import concurrent.futures
+import threading
+import collections
+import queue
+import random
+import asyncio
+import contextlib
+import contextvars
+import atexit
 import datetime
-import pyautogui
-import pyclip
 import time
-import pprint
+
+# Heavy or GUI-only modules (pyautogui, pyclip, pyrogram, numpy, tomllib) are imported by the
+# subcommands that use them, so everything else starts fast and runs without a display.
+BLUE, GREEN, YELLOW, ON_RED, RESET = "\x1b[34m", "\x1b[32m", "\x1b[33m", "\x1b[41m", "\x1b[0m"
+if os.name == "nt":
+    # older Windows consoles need colorama to understand the escape codes
+    import colorama; colorama.just_fix_windows_console()
 
 def log(*string):
-    print(f" {colorama.Fore.BLUE}INFO{colorama.Style.RESET_ALL} ", *string)
+    print(f" {BLUE}INFO{RESET} ", *string)
 
 def fatal(*string):
-    print(f" {colorama.Back.RED}FATAL{colorama.Style.RESET_ALL}", *string)
+    print(f" {ON_RED}FATAL{RESET}", *string)
     sys.exit(1)
 
 def fatal_non_lethal(*string):
-    print(f" {colorama.Back.RED}FATAL{colorama.Style.RESET_ALL}", *string)
+    print(f" {ON_RED}FATAL{RESET}", *string)
     
 def usage(*string):
-    print(f" {colorama.Fore.GREEN}USAGE{colorama.Style.RESET_ALL}", *string)
+    print(f" {GREEN}USAGE{RESET}", *string)
+
+# (uid, stage) of the work running in the current thread or task, used to tag trace records
+trace_context = contextvars.ContextVar("trace_context", default=(None, None))
+trace_records = []
+trace_lock = threading.Lock()
+
+def trace(record):
+    # every record is kept for the end-of-run summary and appended to vods/<uid>.trace.jsonl
+    uid, stage = trace_context.get()
+    record = {"time": time.time(), "uid": uid, "stage": stage, **record}
+    with trace_lock:
+        trace_records.append(record)
+        if uid is not None and os.path.isdir("vods"):
+            with open(f"vods/{uid}.trace.jsonl", "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+class TracedPopen(subprocess.Popen):
+    # Popen reaps the child with waitpid(), which throws its resource usage away; wait4() keeps it
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        if not hasattr(os, "wait4"): return super()._try_wait(wait_flags)
+        try:
+            pid, status, self.rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            pid, status = self.pid, 0
+        return pid, status
+
+def trace_process(proc, start):
+    record = {"type": "process", "argv": proc.args, "exit": proc.returncode, "wall_s": round(time.perf_counter() - start, 4)}
+    if proc.rusage is not None:
+        record.update(cpu_s=round(proc.rusage.ru_utime + proc.rusage.ru_stime, 4), max_rss_kib=proc.rusage.ru_maxrss,
+                      read_bytes=proc.rusage.ru_inblock * 512, written_bytes=proc.rusage.ru_oublock * 512)
+    trace(record)
+
+def run_traced(arglist, **kwargs):
+    if kwargs.pop("capture_output", False): kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+    start = time.perf_counter()
+    with TracedPopen(list(map(str, arglist)), **kwargs) as proc:
+        stdout, stderr = proc.communicate()
+    trace_process(proc, start)
+    return subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr)
 
 def cmd(arglist, **kwargs):
-    print(f" {colorama.Fore.YELLOW}CMD{colorama.Style.RESET_ALL}  ", *arglist)
-    return subprocess.run(map(str, arglist), **kwargs)
+    print(f" {YELLOW}CMD{RESET}  ", *arglist)
+    return run_traced(arglist, **kwargs)
 
 def cmd_silent(arglist, **kwargs):
-    return subprocess.run(map(str, arglist), **kwargs)
+    return run_traced(arglist, **kwargs)
+
+@contextlib.contextmanager
+def traced_stage(uid, stage):
+    token = trace_context.set((uid, stage))
+    start, cpu = time.perf_counter(), time.thread_time()
+    try: yield
+    finally:
+        trace({"type": "stage", "wall_s": round(time.perf_counter() - start, 4), "cpu_s": round(time.thread_time() - cpu, 4)})
+        trace_context.reset(token)
+
+def in_stage(uid, stage, func, *args):
+    with traced_stage(uid, stage): return func(*args)
+
+def submit_traced(pool, func, *args):
+    # pool threads don't inherit context variables, so the current stage is handed over explicitly
+    return pool.submit(contextvars.copy_context().run, func, *args)
+
+def print_trace_summary():
+    stages = [i for i in trace_records if i["type"] == "stage"]
+    processes = [i for i in trace_records if i["type"] == "process"]
+    if not stages and not processes: return
+    print(f"{'uid':>12} {'stage':>16} {'wall':>9} {'cpu':>9} {'procs':>5} {'proc cpu':>9} {'read':>10} {'written':>10}")
+    for i in stages or [{"uid": None, "stage": None, "wall_s": 0, "cpu_s": 0}]:
+        mine = [j for j in processes if j["uid"] == i["uid"] and j["stage"] == i["stage"]]
+        print(f"{str(i['uid']):>12} {str(i['stage']):>16} {i['wall_s']:>8.2f}s {i['cpu_s']:>8.2f}s {len(mine):>5} "
+              f"{sum(j.get('cpu_s', 0) for j in mine):>8.2f}s {pretty_bytes(sum(j.get('read_bytes', 0) for j in mine)):>10} "
+              f"{pretty_bytes(sum(j.get('written_bytes', 0) for j in mine)):>10}")
 
 def isint(string):
     try:
@@ -47,21 +136,73 @@ def lerp(a, b, t):
     return a + (b - a) * t
 
 def log_usage(program="vodtool"):
-    usage(f"{program} <subcommand> [args]")
+    usage(f"{program} <subcommand> [args] [--trace-summary]")
+    usage(f"Every subprocess and stage is traced to vods/<uid>.trace.jsonl, `--trace-summary` prints a table at exit")
     usage(f"Subcommands:")
     usage(f" - `help`: print this message")
     usage(f"   args: none")
     usage(f" - `download`: download a stream, download a chat capture, split and generate chapter map")
-    usage(f"   args: <link>")
+    usage(f"   args: <link> [--jobs N] [--chunk-size SIZE] [--views] [--yt-dlp] [--stream [--keep-source]]")
+    usage(f" - `download-batch`: `download` every VOD link in a file, resuming an interrupted run")
+    usage(f"   args: <links.txt> [--jobs N] [--net-jobs N] [--local-jobs N] [--chunk-size SIZE] [--views] [--yt-dlp] [--stream [--keep-source]]")
     usage(f" - `categorize`: parse category file, split the vod and generate chapter map")
+    usage(f"   args: <uid> [--jobs N] [--chunk-size SIZE] [--views]")
+    usage(f" - `print-chapter-map`: print a formatted chapter map, `--ranges` adds chapter end times")
+    usage(f"   args: <uid> [--ranges]")
+    usage(f" - `upload`: use pyautogui (or the Telegram API with `--api`) to upload the vod to Telegram")
+    usage(f"   args: <uid> [--post] [--no-chat] [--from-chunk N] [--api] [--message ID] [--uploads N]")
+    usage(f" - `download-clips`: download every clip and its chat capture from a list of clip links, cutting them out of local VODs when possible")
+    usage(f"   args: <clips.txt> [--jobs N]")
+    usage(f" - `compact-chat`: pack chat captures into compressed `.chat` files, `--remove` deletes the verified originals")
+    usage(f"   args: <capture.json>... [--remove]")
+    usage(f" - `expand-chat`: unpack `.chat` files back into ttvdl chat captures")
+    usage(f"   args: <capture.chat>...")
+    usage(f" - `slice-chat`: cut the chat capture into vods/<uid>/<k>.json, one per chunk, with offsets from the chunk start")
     usage(f"   args: <uid>")
-    usage(f" - `print-chapter-map`: print a formatted chapter map")
-    usage(f"   args: <uid>")
-    usage(f" - `upload`: use pyautogui to upload the vod to Telegram")
-    usage(f"   args: <uid> [--post] [--no-chat] [--from-chunk N]")
-    usage(f" - `download-clips`: use pyautogui to upload the vod to Telegram")
-    usage(f"   args: <clips.txt>")
+    usage(f" - `search-chat`: print comments containing all the words, optionally between two times of the VOD")
+    usage(f"   args: <uid> [words...] [--from TIME] [--to TIME]")
+    usage(f" - `analyze`: find chat activity peaks (needs numpy) and draft vods/<uid>.draft.cat from them")
+    usage(f"   args: <uid> [--window SECONDS] [--top N]")
+    usage(f"SIZE is the byte limit of a chunk, with an optional binary K/M/G suffix (default and maximum: {CHUNK_SIZE})")
+    usage(f"VODs are fetched segment by segment with adaptive concurrency, `--yt-dlp` uses yt-dlp instead")
+    usage(f"`--stream` writes the chunks while downloading and drops the full VOD unless `--keep-source` is given")
+    usage(f"`--views` keeps chunks as time ranges of the source, remuxed while `upload --api` sends them, instead of files")
     
+def parse_count(args, n):
+    if n >= len(args): fatal(f"Expected a number after {args[n - 1]}")
+    count = args[n]
+    if not isint(count): fatal(f"{count} is not a number")
+    count = int(count)
+    if count <= 0: fatal(f"{args[n - 1]} should be 1 or more")
+    return count
+
+def parse_size(args, n):
+    # plain bytes or a K/M/G suffix, binary like pretty_bytes
+    if n >= len(args): fatal(f"Expected a size after {args[n - 1]}")
+    size = args[n].upper().removesuffix("B").removesuffix("I")
+    unit = 1024 ** ("KMG".index(size[-1]) + 1) if size and size[-1] in "KMG" else 1
+    if unit > 1: size = size[:-1]
+    if not isint(size) or int(size) * unit <= 2 * CHUNK_HEADROOM: fatal(f"{args[n]} is not a valid chunk size")
+    if int(size) * unit > CHUNK_SIZE: fatal(f"{args[n]} is over the upload limit of {CHUNK_SIZE} bytes")
+    return int(size) * unit
+
+def parse_time(args, n):
+    # seconds, MM:SS or HH:MM:SS
+    if n >= len(args): fatal(f"Expected a time after {args[n - 1]}")
+    parts = args[n].split(":")
+    if len(parts) > 3 or not all(isint(i) and int(i) >= 0 for i in parts): fatal(f"{args[n]} is not a time")
+    return sum(int(i) * 60 ** k for k, i in enumerate(reversed(parts)))
+
+def check_stream_args(stream, keep_source, views, ytdlp):
+    if keep_source and not stream: fatal("--keep-source only makes sense with --stream")
+    if stream and views: fatal("--views needs the full VOD to cut from, it can't be used with --stream")
+    if stream and ytdlp: fatal("--stream fetches the segments itself, it can't be used with --yt-dlp")
+
+def parse_vod_link(link):
+    if not (link.startswith("https://twitch.tv/videos/") or link.startswith("https://www.twitch.tv/videos/")):
+        fatal(f"Not a Twitch VOD link: {link}")
+    return int(link.split("/")[4].split("?")[0])
+
 def parse_args(args):
     program = args.pop(0)
     if len(args) == 0:
@@ -74,42 +215,215 @@ def parse_args(args):
         log_usage(program)
         sys.exit(0)
     elif subcommand == "download":
-        if len(args) == 0:
+        link = None
+        jobs = 1
+        chunk_size = CHUNK_SIZE
+        views = False
+        ytdlp = False
+        stream = False
+        keep_source = False
+
+        n = 0
+        while n < len(args):
+            i = args[n]
+            if i == "--jobs":
+                n += 1
+                jobs = parse_count(args, n)
+            elif i == "--chunk-size":
+                n += 1
+                chunk_size = parse_size(args, n)
+            elif i == "--views": views = True
+            elif i == "--yt-dlp": ytdlp = True
+            elif i == "--stream": stream = True
+            elif i == "--keep-source": keep_source = True
+            else:
+                if link is None: link = i
+                else: fatal("Expected only one link in arguments")
+            n += 1
+
+        if link is None:
             log_usage(program)
             fatal("Expected a link")
-        link = args.pop(0)
-        if not (link.startswith("https://twitch.tv/videos/") or link.startswith("https://www.twitch.tv/videos/")):
-            fatal("Not a Twitch VOD link")
-        return "download", [int(link.split("/")[4].split("?")[0])]
+        check_stream_args(stream, keep_source, views, ytdlp)
+        return "download", [parse_vod_link(link), jobs, chunk_size, views, ytdlp, stream, keep_source]
+    elif subcommand == "download-batch":
+        links_file = None
+        jobs, net_jobs, local_jobs = 1, 2, 1
+        chunk_size = CHUNK_SIZE
+        views = False
+        ytdlp = False
+        stream = False
+        keep_source = False
+
+        n = 0
+        while n < len(args):
+            i = args[n]
+            if i == "--jobs":
+                n += 1
+                jobs = parse_count(args, n)
+            elif i == "--chunk-size":
+                n += 1
+                chunk_size = parse_size(args, n)
+            elif i == "--views": views = True
+            elif i == "--yt-dlp": ytdlp = True
+            elif i == "--stream": stream = True
+            elif i == "--keep-source": keep_source = True
+            elif i == "--net-jobs":
+                n += 1
+                net_jobs = parse_count(args, n)
+            elif i == "--local-jobs":
+                n += 1
+                local_jobs = parse_count(args, n)
+            else:
+                if links_file is None: links_file = i
+                else: fatal("Expected only one links file in arguments")
+            n += 1
+
+        if links_file is None:
+            log_usage(program)
+            fatal("Expected a links file")
+        check_stream_args(stream, keep_source, views, ytdlp)
+        return "download-batch", [links_file, jobs, net_jobs, local_jobs, chunk_size, views, ytdlp, stream, keep_source]
     elif subcommand == "categorize":
-        if len(args) == 0:
+        uid = None
+        jobs = 1
+        chunk_size = CHUNK_SIZE
+        views = False
+
+        n = 0
+        while n < len(args):
+            i = args[n]
+            if i == "--jobs":
+                n += 1
+                jobs = parse_count(args, n)
+            elif i == "--chunk-size":
+                n += 1
+                chunk_size = parse_size(args, n)
+            elif i == "--views": views = True
+            else:
+                if uid is None: uid = i
+                else: fatal("Expected only one UID in arguments")
+            n += 1
+
+        if uid is None:
             log_usage(program)
             fatal("Expected a UID")
-        uid = args.pop(0)
-        return "categorize", [uid]
+        return "categorize", [uid, jobs, chunk_size, views]
     elif subcommand == "print-chapter-map":
-        if len(args) == 0:
+        uid = None
+        ranges = False
+
+        for i in args:
+            if i == "--ranges": ranges = True
+            elif uid is None: uid = i
+            else: fatal("Expected only one UID in arguments")
+
+        if uid is None:
             log_usage(program)
             fatal("Expected an UID")
         
-        return "print-chapter-map", [args.pop(0)]
+        return "print-chapter-map", [uid, ranges]
     elif subcommand == "download-clips":
-        if len(args) == 0:
+        clips_file = None
+        jobs = 4
+
+        n = 0
+        while n < len(args):
+            i = args[n]
+            if i == "--jobs":
+                n += 1
+                jobs = parse_count(args, n)
+            else:
+                if clips_file is None: clips_file = i
+                else: fatal("Expected only one clips file in arguments")
+            n += 1
+
+        if clips_file is None:
             log_usage(program)
             fatal("Expected a clips file")
-        
-        return "download-clips", [args.pop(0)]
+        return "download-clips", [clips_file, jobs]
+    elif subcommand in ("compact-chat", "expand-chat"):
+        paths = []
+        remove = False
+
+        for i in args:
+            if i == "--remove" and subcommand == "compact-chat": remove = True
+            else: paths.append(i)
+
+        if not paths:
+            log_usage(program)
+            fatal("Expected at least one chat capture")
+        return subcommand, [paths, remove]
+    elif subcommand == "slice-chat":
+        if len(args) != 1:
+            log_usage(program)
+            fatal("Expected an UID")
+        return "slice-chat", [args[0]]
+    elif subcommand == "search-chat":
+        uid = None
+        words = []
+        start, end = 0, math.inf
+
+        n = 0
+        while n < len(args):
+            i = args[n]
+            if i == "--from":
+                n += 1
+                start = parse_time(args, n)
+            elif i == "--to":
+                n += 1
+                end = parse_time(args, n)
+            elif uid is None: uid = i
+            else: words.append(i)
+            n += 1
+
+        if uid is None:
+            log_usage(program)
+            fatal("Expected an UID")
+        return "search-chat", [uid, words, start, end]
+    elif subcommand == "analyze":
+        uid = None
+        window, top = 60, 10
+
+        n = 0
+        while n < len(args):
+            i = args[n]
+            if i == "--window":
+                n += 1
+                window = parse_count(args, n)
+            elif i == "--top":
+                n += 1
+                top = parse_count(args, n)
+            else:
+                if uid is None: uid = i
+                else: fatal("Expected only one UID in arguments")
+            n += 1
+
+        if uid is None:
+            log_usage(program)
+            fatal("Expected an UID")
+        return "analyze", [uid, window, top]
     elif subcommand == "upload":
         uid = None
         post = False
         chat = True
         from_chunk = 1
+        api = False
+        message = None
+        uploads = 3
 
         n = 0
         while n < len(args):
             i = args[n]
             if i == "--post": post = True
             elif i == "--no-chat": chat = False
+            elif i == "--api": api = True
+            elif i == "--message":
+                n += 1
+                message = parse_count(args, n)
+            elif i == "--uploads":
+                n += 1
+                uploads = parse_count(args, n)
             elif i == "--from-chunk":
                 n += 1
                 from_chunk = args[n]
@@ -125,7 +439,7 @@ def parse_args(args):
             log_usage(program)
             fatal("Expected an UID")
         
-        return "upload", [uid, post, chat, from_chunk]
+        return "upload", [uid, post, chat, from_chunk, api, message, uploads]
     else:
         log_usage(program)
         fatal("No such subcommand")
@@ -135,13 +449,267 @@ def makedir(path, silent=False):
         if not silent: log(f"No {path}/ directory, creating one")
         os.mkdir(path)
 
-def download_vod(uid):
+def write_json_atomic(path, obj):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+def file_stamp(path):
+    if not os.path.isfile(path): return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+meta_lock = threading.Lock()
+
+def load_meta(uid):
+    if not os.path.isfile(f"vods/{uid}.meta.json"): return {}
+    try: return json.load(open(f"vods/{uid}.meta.json", encoding="utf-8"))
+    except ValueError: return {}
+
+def meta_get(uid, key, stamp):
+    # an entry is only valid while the stamp (file sizes/mtimes, settings) it was stored with still matches
+    with meta_lock:
+        entry = load_meta(uid).get(key)
+    if entry is None or entry["stamp"] != stamp: return None
+    return entry["value"]
+
+def meta_put(uid, key, stamp, value):
+    with meta_lock:
+        meta = load_meta(uid)
+        meta[key] = {"stamp": stamp, "value": value}
+        write_json_atomic(f"vods/{uid}.meta.json", meta)
+    return value
+
+def cached(uid, key, stamp, compute):
+    value = meta_get(uid, key, stamp)
+    if value is None: value = meta_put(uid, key, stamp, compute())
+    return value
+
+def download_vod(uid, ytdlp=False):
     if os.path.isfile(f"vods/{uid}.mp4"):
         log(f"VOD {uid} already downloaded, skipping")
-    else:
-        log(f"Downloading VOD {uid}")
+    elif ytdlp:
+        log(f"Downloading VOD {uid} with yt-dlp")
         if cmd(["yt-dlp", f"https://twitch.tv/videos/{uid}", "-o", f"vods/{uid}.mp4", "-N", "12"]).returncode != 0:
             fatal("yt-dlp exited with non-zero exit code, bailing out")
+    else:
+        log(f"Downloading VOD {uid}")
+        segments, bandwidth = get_vod_playlist(uid)
+        fetch_hls(segments, f"vods/{uid}.ts", f"vods/{uid}.hls.json", bandwidth)
+        remux_ts(f"vods/{uid}.ts", f"vods/{uid}.mp4")
+        os.remove(f"vods/{uid}.ts")
+        os.remove(f"vods/{uid}.hls.json")
+
+def http_text(url):
+    import urllib.request
+    with urllib.request.urlopen(url, timeout=30) as response: return response.read().decode("utf-8")
+
+def parse_m3u8(text, base):
+    # (variants, segments): (bandwidth, url) of every stream of a master playlist, (url, duration) of every segment of a media one
+    import urllib.parse
+    variants, segments, bandwidth, duration = [], [], None, None
+    for line in map(str.strip, text.splitlines()):
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            found = re.search(r"(?:^|,)BANDWIDTH=(\d+)", line[18:])
+            bandwidth = int(found.group(1)) if found else 0
+        elif line.startswith("#EXTINF:"): duration = float(line[8:].split(",")[0])
+        elif line and not line.startswith("#"):
+            if bandwidth is not None: variants.append((bandwidth, urllib.parse.urljoin(base, line)))
+            elif duration is not None: segments.append((urllib.parse.urljoin(base, line), duration))
+            bandwidth = duration = None
+    return variants, segments
+
+def get_vod_playlist(uid):
+    # the same way the Twitch player gets it: a playback token from GQL, the master playlist from usher, then the best stream
+    import urllib.parse
+    query = f'query {{ videoPlaybackAccessToken(id: "{uid}", params: {{platform: "web", playerBackend: "mediaplayer", playerType: "site"}}) {{ value signature }} }}'
+    token = (gql(query).get("data") or {}).get("videoPlaybackAccessToken")
+    if not token: fatal(f"Twitch gave no playback token for VOD {uid}, is it deleted or subscriber-only?")
+    url = f"https://usher.ttvnw.net/vod/{uid}.m3u8?" + urllib.parse.urlencode({"sig": token["signature"], "token": token["value"],
+        "allow_source": "true", "allow_audio_only": "true", "player": "twitchweb", "p": random.randint(0, 999999)})
+    variants, _ = parse_m3u8(http_text(url), url)
+    if not variants: fatal(f"No streams in the playlist of VOD {uid}")
+    bandwidth, url = max(variants)
+    _, segments = parse_m3u8(http_text(url), url)
+    if not segments: fatal(f"No segments in the playlist of VOD {uid}")
+    log(f"VOD {uid}: {len(segments)} segments, {pretty_time(sum(d for _, d in segments))}, {bandwidth / 1e6:.1f} Mbit/s")
+    return segments, bandwidth
+
+class Throttle:
+    # AIMD limit on requests in flight: one more while that keeps raising the throughput, one less when
+    # latency balloons without a throughput gain, half as many after a failed request
+    def __init__(self, start=4, ceiling=32):
+        self.limit, self.ceiling, self.active = start, ceiling, 0
+        self.cond = threading.Condition()
+        self.rate, self.base_latency = 0.0, math.inf
+        self.reset()
+
+    def reset(self):
+        self.window_start, self.window_bytes, self.latencies = time.perf_counter(), 0, []
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit: self.cond.wait()
+            self.active += 1
+
+    def release(self, size=0, latency=None):
+        with self.cond:
+            self.active -= 1
+            if latency is None:
+                self.limit = max(1, self.limit // 2)
+                self.rate = 0.0
+                self.reset()
+            else:
+                self.window_bytes += size
+                self.latencies.append(latency)
+                self.base_latency = min(self.base_latency, latency)
+                elapsed = time.perf_counter() - self.window_start
+                if elapsed >= 2 and len(self.latencies) >= self.limit:
+                    rate = self.window_bytes / elapsed
+                    if rate > self.rate * 1.05: self.limit = min(self.ceiling, self.limit + 1)
+                    elif sorted(self.latencies)[len(self.latencies) // 2] > 2 * self.base_latency: self.limit = max(1, self.limit - 1)
+                    self.rate = rate
+                    self.reset()
+            self.cond.notify_all()
+
+def http_get(connections, url):
+    # keep-alive connections are kept per worker and host; returns (status, body, seconds to the first byte)
+    import http.client, urllib.parse
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    if key not in connections:
+        connection = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        connections[key] = connection(parts.netloc, timeout=30)
+    start = time.perf_counter()
+    try:
+        connections[key].request("GET", parts.path + ("?" + parts.query if parts.query else ""))
+        response = connections[key].getresponse()
+        latency = time.perf_counter() - start
+        return response.status, response.read(), latency
+    except (OSError, http.client.HTTPException):
+        connections.pop(key).close()
+        raise
+
+HLS_RETRIES = 8
+HLS_WRITE_SIZE = 16 * 1024 * 1024
+
+def fetch_segments(urls, first=0, name="segments", start_jobs=4, max_jobs=32):
+    # Yields (n, data) for urls[first:] strictly in order. Segments are fetched by a pool of workers under
+    # an adaptive Throttle, and the workers stay a bounded distance ahead of the consumer, so the reorder
+    # buffer stays small however slow the consumer is.
+    import http.client
+    urls = list(urls)
+    throttle = Throttle(start_jobs, max_jobs)
+    results, stop = queue.Queue(), threading.Event()
+    cursor = {"next": first, "written": first}
+
+    def claim():
+        with throttle.cond:
+            while not stop.is_set() and cursor["next"] < len(urls) and cursor["next"] >= cursor["written"] + max(8, 2 * throttle.limit):
+                throttle.cond.wait()
+            if stop.is_set() or cursor["next"] >= len(urls): return None
+            cursor["next"] += 1
+            return cursor["next"] - 1
+
+    def worker():
+        connections = {}
+        while (i := claim()) is not None:
+            attempt, error = 0, None
+            while attempt < HLS_RETRIES:
+                throttle.acquire()
+                start = time.perf_counter()
+                try: status, data, latency = http_get(connections, urls[i])
+                except (OSError, http.client.HTTPException) as e: status, error = None, e
+                if status == 200:
+                    throttle.release(len(data), latency)
+                    trace({"type": "segment", "n": i, "bytes": len(data), "latency_s": round(latency, 4),
+                           "wall_s": round(time.perf_counter() - start, 4), "attempts": attempt + 1, "limit": throttle.limit})
+                    results.put((i, data))
+                    break
+                if status is not None: error = f"HTTP {status}"
+                if status == 403 and "-unmuted." in urls[i]:
+                    # Twitch lists muted parts as -unmuted, but only serves them as -muted; not a failed attempt
+                    throttle.release(0, time.perf_counter() - start)
+                    urls[i] = urls[i].replace("-unmuted.", "-muted.")
+                    continue
+                attempt += 1
+                throttle.release()
+                if stop.is_set(): break
+                if attempt < HLS_RETRIES: time.sleep(min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1))
+            else:
+                results.put((i, error))
+            if status != 200: break
+        for i in connections.values(): i.close()
+
+    workers = [threading.Thread(target=contextvars.copy_context().run, args=(worker,), daemon=True) for _ in range(max_jobs)]
+    for i in workers: i.start()
+
+    pending = {}
+    started, last_report, fetched = time.perf_counter(), time.perf_counter(), 0
+    try:
+        while cursor["written"] < len(urls):
+            i, data = results.get()
+            if not isinstance(data, bytes): fatal(f"Segment {i} of {name} failed {HLS_RETRIES} times: {data}")
+            pending[i] = data
+            fetched += len(data)
+            while cursor["written"] in pending:
+                data = pending.pop(cursor["written"])
+                with throttle.cond:
+                    cursor["written"] += 1
+                    throttle.cond.notify_all()
+                yield cursor["written"] - 1, data
+            if time.perf_counter() - last_report >= 10:
+                last_report = time.perf_counter()
+                log(f"{name}: {cursor['written']}/{len(urls)} segments, {pretty_bytes(fetched / (last_report - started))}/s, {throttle.limit} connections")
+    finally:
+        stop.set()
+        with throttle.cond: throttle.cond.notify_all()
+    log(f"{name}: {len(urls) - first} segments, {pretty_bytes(fetched)} in {pretty_time(time.perf_counter() - started)}")
+
+def preallocate(fd, offset, size):
+    # reserve the expected size up front, so the file is laid out in few extents
+    if size <= 0 or not hasattr(os, "posix_fallocate"): return
+    try: os.posix_fallocate(fd, offset, size)
+    except OSError: pass
+
+def fetch_hls(segments, path, state_path, bandwidth=None):
+    # Segments are written to `path` in large writes. `state_path` records how many segments and bytes
+    # are safely on disk, so an interrupted download continues from there.
+    state = {"count": len(segments), "written": 0, "size": 0}
+    if os.path.isfile(state_path) and os.path.isfile(path):
+        saved = json.load(open(state_path, encoding="utf-8"))
+        if saved.get("count") == len(segments) and "written" in saved and os.path.getsize(path) >= saved["size"]: state = saved
+    if state["written"]: log(f"Resuming {path} from segment {state['written']}/{len(segments)}")
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    os.ftruncate(fd, state["size"])
+    if bandwidth: preallocate(fd, state["size"], int(bandwidth / 8 * sum(d for _, d in segments[state["written"]:])))
+    buffer = bytearray()
+    def flush(written):
+        os.pwrite(fd, buffer, state["size"])
+        state["size"] += len(buffer)
+        state["written"] = written
+        buffer.clear()
+        write_json_atomic(state_path, state)
+
+    try:
+        for i, data in fetch_segments([url for url, _ in segments], state["written"], path):
+            buffer += data
+            if len(buffer) >= HLS_WRITE_SIZE: flush(i + 1)
+        flush(len(segments))
+    finally:
+        os.ftruncate(fd, state["size"])
+        os.close(fd)
+
+def remux_ts(path, output):
+    # MPEG-TS as fetched to MP4, through a temporary name so a broken remux never looks like a finished download
+    args = ["ffmpeg", "-i", path, "-c", "copy", "-bsf:a", "aac_adtstoasc", output.removesuffix(".mp4") + ".part.mp4", "-y"]
+    call = cmd(args, capture_output=True)
+    if call.returncode != 0:
+        for i in call.stderr.split(b"\n"):
+            fatal_non_lethal(i.decode())
+        fatal("ffmpeg exited with non-zero exit code")
+    os.replace(output.removesuffix(".mp4") + ".part.mp4", output)
 
 def download_clip_video(uid):
     if os.path.isfile(f"clips/{uid}.mp4"):
@@ -153,7 +721,8 @@ def download_clip_video(uid):
         print()
 
 def download_chat(uid, clip=False):
-    if os.path.isfile(("clips" if clip else "vods") + f"/{uid}.json"):
+    base = ("clips" if clip else "vods") + f"/{uid}"
+    if os.path.isfile(base + ".json") or os.path.isfile(base + ".chat"):
         log(f"Chat Capture for " + ("clip" if clip else "VOD") + f" {uid} already downloaded, skipping")
     else:
         log(f"Downloading Chat Capture for " + ("clip" if clip else "VOD") + f" {uid}")
@@ -173,25 +742,304 @@ def pretty_time(s):
     s = int(s)
     return f"{h:0>2}:{m%60:0>2}:{s%60:0>2}"
 
+def mp4_boxes(data, start, end):
+    while start + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:
+            if start + 16 > end: return
+            size, header = struct.unpack_from(">Q", data, start + 8)[0], 16
+        elif size == 0: size = end - start
+        if size < header or start + size > end: return
+        yield kind, start + header, start + size
+        start += size
+
+def mp4_duration(path):
+    # duration straight from moov/mvhd, no process spawn; None if the file doesn't have a usable one
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < 8: return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for kind, start, end in mp4_boxes(data, 0, len(data)):
+                if kind != b"moov": continue
+                for kind, start, end in mp4_boxes(data, start, end):
+                    if kind != b"mvhd": continue
+                    if data[start] == 1 and end - start >= 32:
+                        timescale, duration = struct.unpack_from(">IQ", data, start + 20)
+                        unknown = 2**64 - 1
+                    elif data[start] == 0 and end - start >= 20:
+                        timescale, duration = struct.unpack_from(">II", data, start + 12)
+                        unknown = 2**32 - 1
+                    else: return None
+                    # fragmented files (empty_moov) carry a zero here, the real length is in the fragments
+                    if timescale == 0 or duration in (0, unknown): return None
+                    return duration / timescale
+    return None
+
 def get_length(path):
-    fmt = subprocess.run(["ffprobe", "-i", path, "-show_format", "-v", "quiet"], capture_output=True).stdout.decode()
+    duration = mp4_duration(path) if path.endswith(".mp4") else None
+    if duration is not None: return duration
+    fmt = cmd_silent(["ffprobe", "-i", path, "-show_format", "-v", "quiet"], capture_output=True).stdout.decode()
     for i in fmt.split("\n"):
-        if i.startswith("duration="):
-            if i[9:12] == "N/A": return 1.0  # idk why but 0.0 breaks it
+        if i.startswith("duration=") and i[9:12] != "N/A":
             return float(i[9:])
+    fatal(f"Couldn't get duration of {path}")
+
+INDEX_HEADER = struct.Struct("<4sQqdI") # magic, source size, source mtime, duration, keyframe count
+INDEX_ENTRY = struct.Struct("<dQ")       # keyframe pts, byte offset in the source
+
+def build_index(uid):
+    log(f"Indexing keyframes of VOD {uid}")
+    path = f"vods/{uid}.mp4"
+    args = ["ffprobe", "-v", "quiet", "-select_streams", "v:0", "-show_entries", "packet=pts_time,pos,flags:format=duration", "-of", "compact", path]
+    start = time.perf_counter()
+    proc = TracedPopen(args, stdout=subprocess.PIPE)
+    duration, keyframes = None, []
+    for line in proc.stdout:
+        if line.startswith(b"packet|") and b"|flags=K" not in line: continue
+        fields = dict(i.split("=", 1) for i in line.decode().strip().split("|")[1:])
+        if line.startswith(b"packet|"):
+            if fields["pts_time"] != "N/A" and fields["pos"] != "N/A":
+                keyframes.append((float(fields["pts_time"]), int(fields["pos"])))
+        elif line.startswith(b"format|") and fields["duration"] != "N/A":
+            duration = float(fields["duration"])
+    proc.wait()
+    trace_process(proc, start)
+    if proc.returncode != 0: fatal("ffprobe exited with non-zero exit code")
+    if duration is None or not keyframes: fatal(f"Couldn't index VOD {uid}")
+
+    stat = os.stat(path)
+    with open(f"vods/{uid}.idx", "wb") as f:
+        f.write(INDEX_HEADER.pack(b"VIDX", stat.st_size, stat.st_mtime_ns, duration, len(keyframes)))
+        for i in keyframes: f.write(INDEX_ENTRY.pack(*i))
+    return duration, keyframes
+
+def load_index(uid):
+    stat = os.stat(f"vods/{uid}.mp4")
+    if os.path.isfile(f"vods/{uid}.idx"):
+        data = open(f"vods/{uid}.idx", "rb").read()
+        magic, size, mtime, duration, count = INDEX_HEADER.unpack_from(data)
+        if magic == b"VIDX" and size == stat.st_size and mtime == stat.st_mtime_ns:
+            return duration, list(INDEX_ENTRY.iter_unpack(data[INDEX_HEADER.size:]))
+    return build_index(uid)
+
+CHUNK_SIZE = 2_000_000_000 # upload limit of Telegram
+CHUNK_HEADROOM = 64 * 1024   # ftyp, mvhd and track headers of a chunk, which don't grow with its length
+
+def mp4_overhead(path):
+    # bytes of container boxes (moov and friends) and the end of the media data; the index of a chunk
+    # grows with its length at roughly the same rate per second as the index of the whole source
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        boxes = list(mp4_boxes(data, 0, len(data)))
+    media = [end for kind, _, end in boxes if kind == b"mdat"]
+    if not media: return None
+    return sum(end - start for kind, start, end in boxes if kind != b"mdat"), max(media)
+
+def plan_chunks(uid, chunk_size, scale=1.0):
+    # keyframe-aligned cut points filling every chunk as close to the limit as the size model allows:
+    # a chunk costs its byte span of the source plus its share of the container overhead
+    duration, keyframes = load_index(uid)
+    path = f"vods/{uid}.mp4"
+    layout = mp4_overhead(path)
+    if layout is None: overhead, media_end = os.path.getsize(path) * 0.05, os.path.getsize(path)
+    else: overhead, media_end = layout
+    rate = overhead / duration if duration > 0 else 0.0
+    cost = [(pos + rate * pts) * scale for pts, pos in keyframes]
+    end_cost = (media_end + rate * duration) * scale
+    budget = chunk_size - CHUNK_HEADROOM
+
+    cuts, k = [0], 0
+    while end_cost - cost[k] > budget:
+        n = bisect.bisect_right(cost, cost[k] + budget) - 1
+        k = n if n > k else k + 1
+        if k >= len(keyframes): break
+        cuts.append(k)
+
+    plan = []
+    for a, b in zip(cuts, cuts[1:] + [None]):
+        start = keyframes[a][0] if a else 0.0
+        end = keyframes[b][0] if b is not None else duration
+        predicted = (cost[b] if b is not None else end_cost) - cost[a] + CHUNK_HEADROOM
+        plan.append((start, end - start, int(predicted)))
+    return plan
+
+def report_chunk(uid, k, length, predicted=None, size=None):
+    if size is None: size = os.path.getsize(f"vods/{uid}/{k}.mp4")
+    guess = f" (predicted ≈{pretty_bytes(predicted)}, {size / predicted - 1:+.2%})" if predicted else ""
+    log(f"Chunk #{k}; Length: {pretty_time(length)}; File size: ≈{pretty_bytes(size)}{guess}")
+    return size
+
+def split_vod_segment(uid, plan):
+    # one ffmpeg pass over the source, cutting at the planned keyframes
+    segment_times = ",".join(f"{start - 0.001:.3f}" for start, *_ in plan[1:])
+    args = ["ffmpeg", "-i", f"vods/{uid}.mp4", "-c", "copy", "-map", "0",
+            "-f", "segment", "-segment_start_number", 1, *(["-segment_times", segment_times] if segment_times else ["-segment_time", plan[0][1] + 1]),
+            "-segment_list", f"vods/{uid}/segments.csv", "-segment_list_type", "csv",
+            "-reset_timestamps", 1, f"vods/{uid}/%d.mp4", "-y"]
+    call = cmd_silent(args, capture_output=True)
+    if call.returncode != 0:
+        fatal_non_lethal("$ " + " ".join(map(str, args)))
+        for i in call.stderr.split(b"\n"):
+            fatal_non_lethal(i.decode())
+        fatal("ffmpeg exited with non-zero exit code")
 
-def split_vod(uid):
+    chunk_sizes = []
+    for k, line in enumerate(open(f"vods/{uid}/segments.csv", encoding="utf-8").read().split(), 1):
+        _, start, end = line.rsplit(",", 2)
+        chunk_sizes.append((float(start), float(end) - float(start)))
+        report_chunk(uid, k, chunk_sizes[-1][1], plan[k - 1][2] if k <= len(plan) else None)
+    os.remove(f"vods/{uid}/segments.csv")
+    return chunk_sizes
+
+def extract_chunk(uid, k, start, length):
+    args = ["ffmpeg", "-ss", start, "-i", f"vods/{uid}.mp4", "-t", length, "-c", "copy", "-map", "0",
+            "-avoid_negative_ts", "make_zero", f"vods/{uid}/{k}.mp4", "-y"]
+    return args, cmd_silent(args, capture_output=True)
+
+def split_vod_parallel(uid, plan, jobs):
+    # every planned chunk is an independent stream copy; the pool size caps concurrent disk streams
+    jobs = min(jobs, os.cpu_count() or 1, len(plan))
+    log(f"Extracting {len(plan)} chunks with {jobs} jobs")
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = {submit_traced(pool, extract_chunk, uid, k, start, length): k for k, (start, length, _) in enumerate(plan, 1)}
+        for future in concurrent.futures.as_completed(futures):
+            k = futures[future]
+            args, call = future.result()
+            if call.returncode != 0:
+                fatal_non_lethal("$ " + " ".join(map(str, args)))
+                for i in call.stderr.split(b"\n"):
+                    fatal_non_lethal(i.decode())
+                fatal("ffmpeg exited with non-zero exit code")
+            report_chunk(uid, k, plan[k - 1][1], plan[k - 1][2])
+    return [(start, length) for start, length, _ in plan]
+
+def view_args(uid, start, length):
+    # bitexact fragmented MP4 on stdout: no seeking back to write the moov, and the same bytes on every run
+    return ["ffmpeg", "-v", "error", "-ss", start, "-i", f"vods/{uid}.mp4", "-t", length, "-c", "copy", "-map", "0",
+            "-avoid_negative_ts", "make_zero", "-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1"]
+
+def view_size(uid, start, length):
+    # dry run of the remux: the output is only counted, nothing is written to disk
+    args = list(map(str, view_args(uid, start, length)))
+    begin = time.perf_counter()
+    proc = TracedPopen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    size = 0
+    while block := proc.stdout.read(1 << 20): size += len(block)
+    stderr = proc.stderr.read()
+    proc.wait()
+    trace_process(proc, begin)
+    if proc.returncode != 0:
+        fatal_non_lethal("$ " + " ".join(args))
+        for i in stderr.split(b"\n"):
+            fatal_non_lethal(i.decode())
+        fatal("ffmpeg exited with non-zero exit code")
+    return size
+
+def measure_views(uid, plan, jobs):
+    jobs = min(jobs, os.cpu_count() or 1, len(plan))
+    log(f"Measuring {len(plan)} chunk views with {jobs} jobs")
+    sizes = [0] * len(plan)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = {submit_traced(pool, view_size, uid, start, length): k for k, (start, length, _) in enumerate(plan, 1)}
+        for future in concurrent.futures.as_completed(futures):
+            k = futures[future]
+            sizes[k - 1] = future.result()
+            report_chunk(uid, k, plan[k - 1][1], plan[k - 1][2], sizes[k - 1])
+    return [(start, length) for start, length, _ in plan], sizes
+
+class ChunkView:
+    # A chunk described as a time range of the source and remuxed while it is read. The remux is
+    # bitexact, so every read yields the same bytes and an interrupted upload can skip to its last part.
+    def __init__(self, uid, k, start, length, size):
+        self.uid, self.start, self.length, self.size = uid, start, length, size
+        self.name = f"{k}.mp4"
+        self.key = f"vods/{uid}.mp4#{k}"
+        self.stamp = [file_stamp(f"vods/{uid}.mp4"), start, length, size]
+
+    @contextlib.contextmanager
+    def open(self, offset=0):
+        begin = time.perf_counter()
+        proc = TracedPopen(list(map(str, view_args(self.uid, self.start, self.length))), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            while offset > 0:
+                skipped = len(proc.stdout.read(min(offset, 1 << 20)))
+                if not skipped: fatal(f"Chunk view {self.key} came out shorter than measured")
+                offset -= skipped
+            yield proc.stdout
+        finally:
+            proc.stdout.close() # stops ffmpeg if the upload gave up early
+            proc.wait()
+            trace_process(proc, begin)
+
+def load_views(uid):
+    # vods/<uid>.views.json exists only while the chunks of a VOD are views rather than files
+    if not os.path.isfile(f"vods/{uid}.views.json"): return None
+    views = json.load(open(f"vods/{uid}.views.json", encoding="utf-8"))
+    if views["source"] != file_stamp(f"vods/{uid}.mp4"): fatal(f"VOD {uid} changed since its chunk views were measured, split it again")
+    return [ChunkView(uid, k, *i) for k, i in enumerate(views["views"], 1)]
+
+def store_chunks(uid, chunk_size, chunk_sizes, sizes=None):
+    # `sizes` is given for views, whose table replaces the chunk files instead of describing them
+    stamp = {"source": file_stamp(f"vods/{uid}.mp4"), "chunk_size": chunk_size}
+    if sizes is None:
+        files = [file_stamp(f"vods/{uid}/{k}.mp4") for k in range(1, len(chunk_sizes) + 1)]
+        meta_put(uid, "chunks", stamp, {"chunks": [[start, length] for start, length in chunk_sizes], "files": files})
+        if os.path.isfile(f"vods/{uid}.views.json"): os.remove(f"vods/{uid}.views.json")
+        return chunk_sizes
+
+    stamp["views"] = True
+    meta_put(uid, "chunks", stamp, {"chunks": [[start, length] for start, length in chunk_sizes], "files": [], "sizes": sizes})
+    write_json_atomic(f"vods/{uid}.views.json", {"source": stamp["source"], "views": [[start, length, size] for (start, length), size in zip(chunk_sizes, sizes)]})
+    stale = [i for i in os.listdir(f"vods/{uid}") if i.endswith(".mp4")] if os.path.isdir(f"vods/{uid}") else []
+    if stale: log(f"Removing {len(stale)} chunk files of VOD {uid}, its chunks are views now")
+    for i in stale: os.remove(f"vods/{uid}/{i}")
+    return chunk_sizes
+
+def load_chunks(uid, chunk_size, views=False):
+    # the chunk table only changes with the source or the size limit; the stamps of the
+    # chunk files themselves make sure nobody deleted or replaced them in the meantime
+    stamp = {"source": file_stamp(f"vods/{uid}.mp4"), "chunk_size": chunk_size}
+    if views: stamp["views"] = True
+    entry = meta_get(uid, "chunks", stamp)
+    if entry is None or "files" not in entry: return None
+    if views and not os.path.isfile(f"vods/{uid}.views.json"): return None
+    if entry["files"] != [file_stamp(f"vods/{uid}/{k}.mp4") for k in range(1, len(entry["files"]) + 1)]: return None
+    return [tuple(i) for i in entry["chunks"]]
+
+def split_vod(uid, jobs=1, chunk_size=CHUNK_SIZE, views=False):
     makedir(f"vods/{uid}", True)
+    # a VOD split while downloading may have no source left, its chunk table is all there is
+    chunk_sizes = load_chunks(uid, chunk_size, views)
+    if chunk_sizes is not None:
+        log(f"VOD {uid} is already split into {len(chunk_sizes)} chunks, reusing them")
+        return chunk_sizes
     if not os.path.isfile(f"vods/{uid}.mp4"):
         fatal(f"VOD {uid} is not downloaded, nothing to split")
 
-    chunk_size = 2_000_000_000
-    full_length = get_length(f"vods/{uid}.mp4")
+    scale = 1.0
+    for attempt in range(2):
+        plan = plan_chunks(uid, chunk_size, scale)
+        log(f"Splitting VOD {uid} into {len(plan)} chunk{' view' if views else ''}s, chunk size ≤{pretty_bytes(chunk_size)}")
+        if views: chunk_sizes, sizes = measure_views(uid, plan, jobs)
+        else:
+            if jobs > 1: chunk_sizes = split_vod_parallel(uid, plan, jobs)
+            else: chunk_sizes = split_vod_segment(uid, plan)
+            sizes = [os.path.getsize(f"vods/{uid}/{k}.mp4") for k in range(1, len(chunk_sizes) + 1)]
+
+        if max(sizes) <= chunk_size:
+            log(f"Total chunks: {len(chunk_sizes)}, the largest one is {max(sizes) / chunk_size:.1%} of the limit")
+            return store_chunks(uid, chunk_size, chunk_sizes, sizes if views else None)
+        # the model undershot somewhere, so scale it by the worst miss and cut again
+        scale *= max(1.0, *(size / predicted for size, (*_, predicted) in zip(sizes, plan))) * 1.01
+        log(f"A chunk came out over the limit, re-planning with the size model scaled by {scale:.3f}")
+
+    if views: fatal(f"Couldn't fit the chunk views of VOD {uid} under {pretty_bytes(chunk_size)}, try a smaller --chunk-size")
+
+    log("Size model keeps undershooting, falling back to splitting chunk by chunk")
+    full_length = sum(length for _, length, _ in plan)
     chunks = 0
     chunk_cursor = 0
     chunk_sizes = []
-    
-    log(f"Splitting VOD {uid}, chunk size ≈{pretty_bytes(chunk_size)}")
 
     while chunk_cursor < full_length:
         chunks += 1
@@ -203,26 +1051,232 @@ def split_vod(uid):
                 fatal_non_lethal(i.decode())
             fatal("ffmpeg exited with non-zero exit code")
         chunk_length = get_length(f"vods/{uid}/{chunks}.mp4")
+        if chunk_length <= 0: fatal(f"Chunk #{chunks} of VOD {uid} came out empty")
         chunk_sizes.append((chunk_cursor, chunk_length))
         chunk_cursor += chunk_length
 
-        log(f"Chunk #{chunks}; Length: {pretty_time(chunk_length)}; File size: ≈{pretty_bytes(os.path.getsize(f'vods/{uid}/{chunks}.mp4'))}")
+        report_chunk(uid, chunks, chunk_length)
 
     log(f"Total chunks: {chunks}")
+    return store_chunks(uid, chunk_size, chunk_sizes)
+
+def stream_vod(uid, jobs=1, chunk_size=CHUNK_SIZE, keep_source=False):
+    # Splits while downloading: every segment goes straight into the ffmpeg of the chunk it belongs to,
+    # and a chunk is closed at a segment boundary once the next segment would take it over the limit.
+    # MPEG-TS carries more overhead than MP4, so the TS bytes of a chunk bound its size. The chunk table
+    # comes from the playlist durations. `vods/<uid>.hls.json` records the finished chunks for resuming.
+    chunk_sizes = load_chunks(uid, chunk_size)
+    if chunk_sizes is not None:
+        log(f"VOD {uid} is already split into {len(chunk_sizes)} chunks, reusing them")
+        return chunk_sizes
+    if os.path.isfile(f"vods/{uid}.mp4"):
+        log(f"VOD {uid} already downloaded, splitting it")
+        return split_vod(uid, jobs, chunk_size)
+
+    makedir(f"vods/{uid}", True)
+    segments, bandwidth = get_vod_playlist(uid)
+    state_path, source = f"vods/{uid}.hls.json", f"vods/{uid}.ts"
+    state = {"count": len(segments), "chunk_size": chunk_size, "source": keep_source, "chunks": [], "size": 0}
+    if os.path.isfile(state_path):
+        saved = json.load(open(state_path, encoding="utf-8"))
+        if all(saved.get(i) == state[i] for i in ("count", "chunk_size", "source")) \
+           and (not keep_source or os.path.isfile(source) and os.path.getsize(source) >= saved["size"]) \
+           and all(file_stamp(f"vods/{uid}/{k}.mp4") == stamp for k, (*_, stamp) in enumerate(saved["chunks"], 1)):
+            state = saved
+    first = sum(count for _, count, _ in state["chunks"])
+    if first: log(f"Resuming VOD {uid} from chunk #{len(state['chunks']) + 1}, segment {first}/{len(segments)}")
+    log(f"Splitting VOD {uid} while downloading, chunk size ≤{pretty_bytes(chunk_size)}")
+
+    fd, offset, buffer = None, state["size"], bytearray()
+    if keep_source:
+        fd = os.open(source, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(fd, offset)
+        preallocate(fd, offset, int(bandwidth / 8 * sum(d for _, d in segments[first:])))
+    durations = [d for _, d in segments]
+    chunk = None
+
+    def open_chunk(first):
+        k = len(state["chunks"]) + 1
+        args = ["ffmpeg", "-v", "error", "-f", "mpegts", "-i", "pipe:", "-c", "copy", "-bsf:a", "aac_adtstoasc",
+                "-f", "mp4", f"vods/{uid}/{k}.part.mp4", "-y"]
+        proc = TracedPopen(list(map(str, args)), stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        return {"k": k, "first": first, "bytes": 0, "proc": proc, "begin": time.perf_counter()}
+
+    def flush():
+        nonlocal offset
+        os.pwrite(fd, buffer, offset)
+        offset += len(buffer)
+        buffer.clear()
+
+    def close_chunk(chunk, count):
+        proc, k = chunk["proc"], chunk["k"]
+        try: proc.stdin.close()
+        except BrokenPipeError: pass
+        stderr = proc.stderr.read()
+        proc.wait()
+        trace_process(proc, chunk["begin"])
+        if proc.returncode != 0:
+            for i in stderr.split(b"\n"):
+                fatal_non_lethal(i.decode())
+            fatal("ffmpeg exited with non-zero exit code")
+        os.replace(f"vods/{uid}/{k}.part.mp4", f"vods/{uid}/{k}.mp4")
+        size = report_chunk(uid, k, sum(durations[chunk["first"]:chunk["first"] + count]))
+        if size > chunk_size: fatal(f"Chunk #{k} of VOD {uid} came out over the limit, try a smaller --chunk-size")
+        # a chunk only counts as done once the source is on disk up to its end
+        if keep_source:
+            flush()
+            os.fsync(fd)
+        state["chunks"].append([chunk["first"], count, file_stamp(f"vods/{uid}/{k}.mp4")])
+        state["size"] = offset
+        write_json_atomic(state_path, state)
+
+    try:
+        for i, data in fetch_segments([url for url, _ in segments], first, f"VOD {uid}"):
+            if len(data) > chunk_size - CHUNK_HEADROOM: fatal(f"Segment {i} of VOD {uid} alone is over the chunk size")
+            if chunk is not None and chunk["bytes"] + len(data) > chunk_size - CHUNK_HEADROOM:
+                close_chunk(chunk, i - chunk["first"])
+                chunk = None
+            if chunk is None: chunk = open_chunk(i)
+            try: chunk["proc"].stdin.write(data)
+            except BrokenPipeError: pass # ffmpeg died, close_chunk says why
+            chunk["bytes"] += len(data)
+            if keep_source:
+                buffer += data
+                if len(buffer) >= HLS_WRITE_SIZE: flush()
+        if chunk is not None: close_chunk(chunk, len(segments) - chunk["first"])
+        chunk = None
+    finally:
+        if chunk is not None:
+            chunk["proc"].kill()
+            chunk["proc"].wait()
+        if fd is not None:
+            os.ftruncate(fd, state["size"])
+            os.close(fd)
+
+    if keep_source:
+        remux_ts(source, f"vods/{uid}.mp4")
+        os.remove(source)
+    chunk_sizes = [(sum(durations[:first], 0.0), sum(durations[first:first + count])) for first, count, _ in state["chunks"]]
+    log(f"Total chunks: {len(chunk_sizes)}")
+    store_chunks(uid, chunk_size, chunk_sizes)
+    os.remove(state_path)
     return chunk_sizes
 
+JSON_WS = re.compile(r"[\s\ufeff]*")
+JSON_NUMBER_TAIL = re.compile(r"[\d.eE+-]*")
+
+def json_spans(path, items=(), block_size=1 << 20):
+    # Walks a file holding one JSON object and yields (key, n, start, end) byte spans: n is None
+    # for top-level values and the element index for elements of top-level arrays named in `items`.
+    # Arrays are decoded one element at a time, so memory stays at one block plus one element.
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    f = open(path, "rb")
+    buf, i, eof = "", 0, False
+    mark, mark_bytes = 0, 0 # buf[mark] sits at byte mark_bytes of the file
+
+    def tell(j):
+        nonlocal mark, mark_bytes
+        mark_bytes += len(buf[mark:j].encode("utf-8"))
+        mark = j
+        return mark_bytes
+
+    def more(n):
+        nonlocal buf, i, mark, eof
+        tell(i)
+        buf, i, mark = buf[i:], 0, 0
+        want = len(buf) + n
+        while len(buf) < want and not eof:
+            block = f.read(max(n, block_size))
+            eof = not block
+            buf += utf8.decode(block, eof)
+
+    def ws():
+        nonlocal i
+        while True:
+            i = JSON_WS.match(buf, i).end()
+            if i < len(buf) or eof: return
+            more(block_size)
+
+    def expect(chars):
+        nonlocal i
+        ws()
+        if i >= len(buf) or buf[i] not in chars: fatal(f"Malformed JSON in `{path}`, expected {chars!r} at byte {tell(i)}")
+        i += 1
+        return buf[i - 1]
+
+    def value():
+        nonlocal i
+        ws()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, i)
+                # a number cut by the block end still decodes, as its prefix, so it has to be followed by something else
+                number = isinstance(obj, (int, float)) and not isinstance(obj, bool)
+                if (JSON_NUMBER_TAIL.match(buf, end).end() if number else end) < len(buf) or eof: break
+            except json.JSONDecodeError:
+                if eof: fatal(f"Malformed JSON in `{path}` at byte {tell(i)}")
+            more(max(len(buf) - i, block_size)) # doubles the window, so big values are not re-parsed too often
+        i = end
+        return obj
+
+    with f:
+        expect("{")
+        ws()
+        if buf[i:i + 1] == "}": return
+        while True:
+            key = value()
+            expect(":")
+            ws()
+            start = tell(i)
+            if buf[i:i + 1] == "[":
+                i += 1
+                ws()
+                if buf[i:i + 1] == "]": i += 1
+                else:
+                    n = 0
+                    while True:
+                        ws()
+                        item_start = tell(i)
+                        value()
+                        if key in items: yield key, n, item_start, tell(i)
+                        n += 1
+                        if expect(",]") == "]": break
+            else: value()
+            yield key, None, start, tell(i)
+            if expect(",}") == "}": break
+
+def read_cc_video(path):
+    # ttvdl writes `video` before `comments`, so this usually stops after the first few KiB
+    for key, _, start, end in json_spans(path):
+        if key == "video":
+            with open(path, "rb") as f:
+                f.seek(start)
+                return json.loads(f.read(end - start))
+    fatal(f"No video info in chat capture `{path}`")
+
+def get_cc_info(uid):
+    # after `compact-chat --remove` only the .chat is left, its head holds the same `video`
+    path = f"vods/{uid}.chat" if os.path.isfile(f"vods/{uid}.chat") and not os.path.isfile(f"vods/{uid}.json") else f"vods/{uid}.json"
+    def compute():
+        if path.endswith(".chat"):
+            store = ChatStore(path)
+            video = store.head.get("video")
+            store.close()
+            if video is None: fatal(f"No video info in chat capture `{path}`")
+        else: video = read_cc_video(path)
+        chapters = [(i["description"], int(i["startMilliseconds"]/1000), int(i["lengthMilliseconds"]/1000)) for i in video["chapters"]]
+        return {"title": video["title"], "created_at": video["created_at"], "chapters": chapters}
+    return cached(uid, "cc", file_stamp(path), compute)
+
 def get_chapters_from_cc(uid):
-    chapters = []
-    chat = json.load(open(f"vods/{uid}.json", encoding="utf-8"))
-    for i in chat["video"]["chapters"]:
-        chapters.append((i["description"], int(i["startMilliseconds"]/1000), int(i["lengthMilliseconds"]/1000)))
-    return chapters
+    return [tuple(i) for i in get_cc_info(uid)["chapters"]]
 
 # вуа пуе_вфеу_тфьу_акщь_сс(гшв)Ж
 
 def get_name_date_from_cc(uid):
-    chat = json.load(open(f"vods/{uid}.json", encoding="utf-8"))
-    return chat["video"]["title"], chat["video"]["created_at"]
+    info = get_cc_info(uid)
+    return info["title"], info["created_at"]
 
 def get_chapters_from_cat(uid):
     chapters = []
@@ -239,31 +1293,416 @@ def get_name_date_from_cat(uid):
     date, name = open(f"vods/{uid}.cat", encoding="utf-8").readlines()[0].rstrip().split(" ", 1)
     return name, date
     
-def generate_chapter_map(uid, chunk_lengths, vod_name, vod_date, chapters):
-    log(f"Generating Chapter Map for VOD {uid}")
-    output = {"name": vod_name, "date": vod_date, "chunks": []}
+CHAT_HEADER = struct.Struct("<4sIIQQQQQQ") # magic, comments per block, flags, comment count, then positions of:
+                                            # offsets, user ids, users, block table, head; arrays are in native byte order
+CHAT_BLOCK = struct.Struct("<QII")          # position, compressed bodies length, compressed remainders length
+CHAT_SORTED = 1                             # flag: offsets never go down, so time ranges can be bisected
+CHAT_GAPS = 2                               # flag: some comments have no offset, stored as NaN and skipped by CHAT_SORTED
+CHAT_BLOCK_SIZE = 4096
 
-    chapter, chapter_start, chapter_offset = 0, 0, 0
-    for chunk_start, chunk_length in chunk_lengths:
-        chunk = []
-        chunk_end = chunk_start + chunk_length
+def compact_json(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
-        while chapter_start + chapter_offset < chunk_end:
-            if chapter >= len(chapters): break
-            chapter_name, chapter_start, chapter_length = chapters[chapter]
+def compact_chat(path, output):
+    # Columnar copy of a ttvdl capture: content offsets as a raw float64 array and commenter ids as a
+    # uint32 array (both readable straight from a memory map), every distinct commenter object stored
+    # once, and bodies and the rest of every comment in zlib blocks. Values taken out of a comment are
+    # left as nulls in its remainder, so the key order survives and expand_chat rebuilds it exactly.
+    # Comments are streamed through json_spans, so the capture never has to fit in memory.
+    offsets, user_ids, users, table = array.array("d"), array.array("I"), {}, []
+    head, bodies, remainders = {}, [], []
+    src = open(path, "rb")
 
-            chunk.append({"name": chapter_name, "start": chapter_start + chapter_offset - chunk_start})
-            if chapter_start + chapter_length > chunk_end:
-                chapter_offset += chunk_start + chunk_length - chapter_start - chapter_offset
-            else:
-                chapter += 1
-                chapter_offset = 0
-        
-        output["chunks"].append(chunk)
+    def flush(f):
+        if not bodies: return
+        packed_bodies, packed_remainders = zlib.compress(compact_json(bodies), 9), zlib.compress(compact_json(remainders), 9)
+        table.append((f.tell(), len(packed_bodies), len(packed_remainders)))
+        f.write(packed_bodies)
+        f.write(packed_remainders)
+        bodies.clear()
+        remainders.clear()
+
+    with src, open(output + ".tmp", "wb") as f:
+        f.write(bytes(CHAT_HEADER.size))
+        for key, n, start, end in json_spans(path, items=("comments",)):
+            if key == "comments" and n is None:
+                head[key] = None
+                continue
+            src.seek(start)
+            value = json.loads(src.read(end - start))
+            if n is None:
+                head[key] = value
+                continue
+
+            offset = value.get("content_offset_seconds") if isinstance(value, dict) else None
+            if type(offset) is float: value["content_offset_seconds"] = None
+            offsets.append(float(offset) if type(offset) in (int, float) else math.nan)
+            if isinstance(value, dict) and "commenter" in value:
+                user_ids.append(users.setdefault(compact_json(value["commenter"]), len(users)))
+                value["commenter"] = None
+            else: user_ids.append(0xFFFFFFFF)
+            message = value.get("message") if isinstance(value, dict) else None
+            if isinstance(message, dict) and "body" in message:
+                bodies.append(message["body"])
+                message["body"] = None
+            else: bodies.append(None)
+            remainders.append(value)
+            if len(bodies) == CHAT_BLOCK_SIZE: flush(f)
+        flush(f)
+
+        present = array.array("d", (i for i in offsets if not math.isnan(i)))
+        in_order = all(a <= b for a, b in zip(present, present[1:]))
+        flags = (CHAT_SORTED if in_order else 0) | (CHAT_GAPS if len(present) < len(offsets) else 0)
+        f.write(bytes(-f.tell() % 8))
+        offsets_pos = f.tell()
+        f.write(offsets.tobytes())
+        user_ids_pos = f.tell()
+        f.write(user_ids.tobytes())
+        users_pos = f.tell()
+        f.write(zlib.compress(b"[" + b",".join(users) + b"]", 9))
+        f.write(bytes(-f.tell() % 8))
+        table_pos = f.tell()
+        for i in table: f.write(CHAT_BLOCK.pack(*i))
+        head_pos = f.tell()
+        f.write(zlib.compress(compact_json(head), 9))
+        f.seek(0)
+        f.write(CHAT_HEADER.pack(b"VCHT", CHAT_BLOCK_SIZE, flags, len(offsets),
+                                 offsets_pos, user_ids_pos, users_pos, table_pos, head_pos))
+    os.replace(output + ".tmp", output)
+
+class ChatStore:
+    # Random access to a compacted capture: offsets and commenter ids are read straight from the
+    # memory map, and only the blocks holding the requested comments are decompressed.
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f: self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.block_size, flags, count, offsets_pos, user_ids_pos, users_pos, table_pos, head_pos = CHAT_HEADER.unpack_from(self.data)
+        if magic != b"VCHT": fatal(f"`{path}` is not a compacted chat capture")
+        self.sorted, self.gaps = bool(flags & CHAT_SORTED), bool(flags & CHAT_GAPS)
+        self.offsets = memoryview(self.data)[offsets_pos:offsets_pos + 8 * count].cast("d")
+        self.keys = self.offsets
+        if self.sorted and self.gaps:
+            # NaN breaks bisection, so missing offsets take the one before them in a copy used for searching
+            self.keys, last = array.array("d", self.offsets), -math.inf
+            for i, offset in enumerate(self.keys):
+                if math.isnan(offset): self.keys[i] = last
+                else: last = offset
+        self.user_ids = memoryview(self.data)[user_ids_pos:user_ids_pos + 4 * count].cast("I")
+        self.users = json.loads(zlib.decompress(self.data[users_pos:table_pos]))
+        self.table = list(CHAT_BLOCK.iter_unpack(self.data[table_pos:head_pos]))
+        self.head = json.loads(zlib.decompress(self.data[head_pos:]))
+        self.block = (None, None, None)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def comment(self, i):
+        n = i // self.block_size
+        if self.block[0] != n:
+            pos, bodies, remainders = self.table[n]
+            self.block = (n, json.loads(zlib.decompress(self.data[pos:pos + bodies])),
+                          json.loads(zlib.decompress(self.data[pos + bodies:pos + bodies + remainders])))
+        _, bodies, remainders = self.block
+        comment = json.loads(compact_json(remainders[i % self.block_size])) # blocks stay cached, so hand out a copy
+        if not isinstance(comment, dict): return comment
+        if comment.get("content_offset_seconds", 0) is None and not math.isnan(self.offsets[i]):
+            comment["content_offset_seconds"] = self.offsets[i]
+        if "commenter" in comment: comment["commenter"] = self.users[self.user_ids[i]]
+        if isinstance(comment.get("message"), dict) and "body" in comment["message"]:
+            comment["message"]["body"] = bodies[i % self.block_size]
+        return comment
+
+    def between(self, start, end):
+        # indices of comments in [start, end) seconds
+        if not self.sorted: return [i for i in range(len(self)) if start <= self.offsets[i] < end]
+        found = range(bisect.bisect_left(self.keys, start), bisect.bisect_left(self.keys, end))
+        if self.gaps: return [i for i in found if not math.isnan(self.offsets[i])]
+        return found
+
+    def close(self):
+        self.offsets.release()
+        self.user_ids.release()
+        self.data.close()
+
+def expand_chat(path, output):
+    store = ChatStore(path)
+    write_chat(output, store.head, map(store.comment, range(len(store))))
+    store.close()
+
+def verify_chat(path, compacted):
+    store = ChatStore(compacted)
+    count = 0
+    with open(path, "rb") as f:
+        for key, n, start, end in json_spans(path, items=("comments",)):
+            if key == "comments" and n is None: continue
+            f.seek(start)
+            original = compact_json(json.loads(f.read(end - start)))
+            if n is None: same = compact_json(store.head.get(key)) == original
+            else: same, count = n < len(store) and compact_json(store.comment(n)) == original, count + 1
+            if not same: fatal(f"`{compacted}` doesn't match `{path}` at {key}" + (f"[{n}]" if n is not None else ""))
+    if count != len(store): fatal(f"`{compacted}` has {len(store)} comments, `{path}` has {count}")
+    store.close()
+
+CHAT_INDEX_HEADER = struct.Struct("<4sIQqQQ") # magic, unused, capture size, capture mtime, comment count, position of the key spans
+                                             # followed by offsets (float64), byte positions (uint64) and byte lengths (uint32)
+
+def build_chat_index(path):
+    # one streaming pass over the capture; comments are sorted by offset, which ttvdl already does
+    log(f"Indexing chat capture {path}")
+    offsets, positions, lengths, spans = array.array("d"), array.array("Q"), array.array("I"), []
+    skipped = 0
+    with open(path, "rb") as f:
+        for key, n, start, end in json_spans(path, items=("comments",)):
+            if n is None:
+                spans.append([key, start, end])
+                continue
+            f.seek(start)
+            comment = json.loads(f.read(end - start))
+            offset = comment.get("content_offset_seconds") if isinstance(comment, dict) else None
+            if type(offset) not in (int, float):
+                skipped += 1
+                continue
+            offsets.append(offset)
+            positions.append(start)
+            lengths.append(end - start)
+    if skipped: log(f"{skipped} comments of {path} have no offset and are left out of the index")
+    if any(a > b for a, b in zip(offsets, offsets[1:])):
+        order = sorted(range(len(offsets)), key=offsets.__getitem__)
+        offsets, positions, lengths = [array.array(i.typecode, (i[j] for j in order)) for i in (offsets, positions, lengths)]
+
+    stat = os.stat(path)
+    spans_pos = CHAT_INDEX_HEADER.size + len(offsets) * 20
+    with open(path.removesuffix(".json") + ".chatidx.tmp", "wb") as f:
+        f.write(CHAT_INDEX_HEADER.pack(b"VCIX", 0, stat.st_size, stat.st_mtime_ns, len(offsets), spans_pos))
+        for i in (offsets, positions, lengths): f.write(i.tobytes())
+        f.write(compact_json(spans))
+    os.replace(path.removesuffix(".json") + ".chatidx.tmp", path.removesuffix(".json") + ".chatidx")
+
+class ChatIndex:
+    # Same interface as ChatStore, over a plain capture and its offset index (<capture>.chatidx):
+    # time ranges are bisected in the memory-mapped index, and only the comments in them are read and parsed.
+    def __init__(self, path):
+        self.path = path
+        index_path = path.removesuffix(".json") + ".chatidx"
+        stat = os.stat(path)
+        header = None
+        if os.path.isfile(index_path):
+            with open(index_path, "rb") as f: header = CHAT_INDEX_HEADER.unpack_from(f.read(CHAT_INDEX_HEADER.size))
+        if header is None or header[0] != b"VCIX" or header[2:4] != (stat.st_size, stat.st_mtime_ns): build_chat_index(path)
+        with open(index_path, "rb") as f: self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, _, _, count, spans_pos = CHAT_INDEX_HEADER.unpack_from(self.data)
+        self.sorted = True
+        view, pos = memoryview(self.data), CHAT_INDEX_HEADER.size
+        self.offsets = view[pos:pos + 8 * count].cast("d")
+        self.positions = view[pos + 8 * count:pos + 16 * count].cast("Q")
+        self.lengths = view[pos + 16 * count:pos + 20 * count].cast("I")
+        self.spans = json.loads(self.data[spans_pos:])
+        self.file = open(path, "rb")
+        self.head = {}
+        for key, start, end in self.spans:
+            if key == "comments": self.head[key] = None
+            else: self.head[key] = json.loads(self.read(start, end - start))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read(self, pos, length):
+        self.file.seek(pos)
+        return self.file.read(length)
+
+    def comment(self, i):
+        return json.loads(self.read(self.positions[i], self.lengths[i]))
+
+    def between(self, start, end):
+        return range(bisect.bisect_left(self.offsets, start), bisect.bisect_left(self.offsets, end))
+
+    def close(self):
+        for i in (self.offsets, self.positions, self.lengths): i.release()
+        self.data.close()
+        self.file.close()
+
+def open_chat(uid):
+    # the plain capture if it is still around, its compacted copy otherwise
+    if os.path.isfile(f"vods/{uid}.json"): return ChatIndex(f"vods/{uid}.json")
+    if os.path.isfile(f"vods/{uid}.chat"): return ChatStore(f"vods/{uid}.chat")
+    fatal(f"No chat capture of VOD {uid}")
+
+def write_chat(path, head, comments):
+    # a ttvdl capture with the given comments in place of the original ones
+    with open(path + ".tmp", "wb") as f:
+        f.write(b"{")
+        for n, (key, value) in enumerate(head.items()):
+            f.write((b"," if n else b"") + compact_json(key) + b":")
+            if key != "comments" or value is not None:
+                f.write(compact_json(value))
+                continue
+            f.write(b"[")
+            for i, comment in enumerate(comments): f.write((b"," if i else b"") + compact_json(comment))
+            f.write(b"]")
+        f.write(b"}")
+    os.replace(path + ".tmp", path)
+
+def slice_chat(uid, ranges):
+    # vods/<uid>/<k>.json holds the comments of chunk k, with offsets relative to the start of the chunk
+    chat = open_chat(uid)
+    makedir(f"vods/{uid}", True)
+    for k, (start, length) in enumerate(ranges, 1):
+        span = chat.between(start, start + length)
+        def rebased():
+            for i in span:
+                comment = chat.comment(i)
+                comment["content_offset_seconds"] = round(comment["content_offset_seconds"] - start, 3)
+                yield comment
+        write_chat(f"vods/{uid}/{k}.json", chat.head, rebased())
+        log(f"Chunk #{k}; {len(span)} comments")
+    chat.close()
+
+def search_chat(uid, words, start, end, ranges):
+    chat = open_chat(uid)
+    words = [i.casefold() for i in words]
+    chunk_starts = [i for i, _ in ranges]
+    found = 0
+    for i in chat.between(start, end):
+        comment = chat.comment(i)
+        message = comment.get("message") or {}
+        body = message.get("body") or "" if isinstance(message, dict) else ""
+        if not all(w in body.casefold() for w in words): continue
+        offset = comment["content_offset_seconds"]
+        commenter = comment.get("commenter") or {}
+        where = ""
+        if ranges:
+            k = max(bisect.bisect_right(chunk_starts, offset) - 1, 0)
+            where = f" [часть №{k + 1} {pretty_time(offset - chunk_starts[k])}]"
+        print(f"{pretty_time(offset)}{where} {commenter.get('display_name', '?')}: {body}")
+        found += 1
+    chat.close()
+    log(f"{found} comments found")
+
+EMOTE_KEY = re.compile(rb'"emoticon_id"')
 
+def emote_counts(chat, np):
+    # emote fragments per comment, in the order of chat.offsets: a plain capture is scanned for the key
+    # of emote fragments and the hits are matched to comment spans, a compacted one is read block by block
+    if isinstance(chat, ChatStore):
+        counts = np.zeros(len(chat), np.int64)
+        for n, (pos, bodies, remainders) in enumerate(chat.table):
+            for i, comment in enumerate(json.loads(zlib.decompress(chat.data[pos + bodies:pos + bodies + remainders]))):
+                message = comment.get("message") if isinstance(comment, dict) else None
+                if isinstance(message, dict) and isinstance(message.get("fragments"), list):
+                    counts[n * chat.block_size + i] = sum(1 for f in message["fragments"] if isinstance(f, dict) and f.get("emoticon"))
+        return counts
+
+    hits, tail, base = array.array("Q"), b"", 0
+    with open(chat.path, "rb") as f:
+        while block := f.read(1 << 24):
+            data = tail + block
+            hits.extend(base - len(tail) + i.start() for i in EMOTE_KEY.finditer(data))
+            tail = data[1 - len(EMOTE_KEY.pattern):]
+            base += len(block)
+    positions, lengths = np.asarray(chat.positions, np.int64), np.asarray(chat.lengths, np.int64)
+    order = np.argsort(positions, kind="stable")
+    hits = np.frombuffer(hits, np.uint64).astype(np.int64)
+    owner = np.searchsorted(positions[order], hits, "right") - 1
+    inside = (owner >= 0) & (hits < positions[order][owner.clip(0)] + lengths[order][owner.clip(0)])
+    return np.bincount(order[owner[inside]], minlength=len(positions))
+
+def analyze_chat(uid, window, top):
+    # Activity statistics over the whole VOD: messages and emotes per second come from bincount,
+    # rolling and baseline rates from convolution; a second is interesting when both rates stand
+    # out from the baseline of the last ten minutes around it.
+    import numpy as np
+    chat = open_chat(uid)
+    offsets = np.array(chat.offsets, np.float64)
+    emotes = emote_counts(chat, np)
+    video = chat.head.get("video") if isinstance(chat.head.get("video"), dict) else {}
+    chat.close()
+
+    start = time.perf_counter()
+    known = ~np.isnan(offsets)
+    offsets, emotes = offsets[known].clip(0), emotes[known]
+    if not len(offsets): fatal(f"Chat capture of VOD {uid} has no comments to analyze")
+    length = int(video.get("length") or 0) or int(offsets.max()) + 1
+    seconds = offsets.astype(np.int64).clip(0, length - 1)
+    messages = np.bincount(seconds, minlength=length).astype(np.float64)
+    emote_rate = np.bincount(seconds, weights=emotes, minlength=length)
+
+    window = min(window, length)
+    def mean(rate, width):
+        # rolling mean; near the ends of the VOD it is taken over the seconds that exist
+        kernel = np.ones(min(width, length))
+        return np.convolve(rate, kernel, "same") / np.convolve(np.ones(length), kernel, "same")
+    rolling, rolling_emotes = mean(messages, window), mean(emote_rate, window)
+    baseline, baseline_emotes = mean(messages, 600), mean(emote_rate, 600)
+    # Poisson-style z-scores: how many standard deviations the window is above what the baseline predicts
+    score = (rolling - baseline) / np.sqrt(baseline / window + 1e-9) + (rolling_emotes - baseline_emotes) / np.sqrt(baseline_emotes / window + 1e-9)
+
+    # strongest seconds first, every pick hides its neighbourhood so highlights don't cluster
+    peaks, taken = [], np.zeros(length, bool)
+    for i in np.argsort(score)[::-1]:
+        if len(peaks) == top or score[i] < 5: break # below that it's mostly noise
+        if taken[i]: continue
+        peaks.append(int(i))
+        taken[max(0, i - window):i + window + 1] = True
+    peaks.sort()
+    log(f"Statistics of {len(offsets)} comments over {pretty_time(length)} computed in {time.perf_counter() - start:.3f}s")
+
+    per_minute = np.convolve(messages, np.ones(60), "valid")
+    log(f"Messages per minute: {len(offsets) / length * 60:.1f} on average, {per_minute.max() if len(per_minute) else len(offsets):.0f} at most")
+    for i in peaks:
+        print(f"{pretty_time(max(0, i - window // 2))}  {rolling[i] * 60:7.1f} msg/min  {rolling_emotes[i] * 60:7.1f} emotes/min  score {score[i]:.1f}")
+
+    # draft chapters: one per highlight, cut at the quietest second between neighbouring highlights
+    cuts = [0] + [a + int(np.argmin(rolling[a:b])) for a, b in zip(peaks, peaks[1:])] + [length]
+    with open(f"vods/{uid}.draft.cat", "w", encoding="utf-8") as f:
+        f.write(f"{video.get('created_at', '')} {video.get('title', uid)}\n")
+        if not peaks: f.write(f"{length} без глав\n")
+        for peak, a, b in zip(peaks, cuts, cuts[1:]): f.write(f"{b - a} момент {pretty_time(peak)}\n")
+    log(f"Draft category file written to vods/{uid}.draft.cat")
+
+def chapter_fragments(chunk_lengths, chapters):
+    # Cuts every chapter at the chunk boundaries it crosses. The first chunk of a chapter is found by
+    # binary search over the chunk starts, so the cost is O(C log K) plus one step per fragment.
+    # Fragment times are relative to their chunk; `continued` marks a chapter carried over from the
+    # previous chunk.
+    starts = [start for start, _ in chunk_lengths]
+    fragments = [[] for _ in chunk_lengths]
+    for name, start, length in sorted(chapters, key=lambda c: c[1]):
+        end = start + length
+        k = max(bisect.bisect_right(starts, start) - 1, 0)
+        while k < len(chunk_lengths):
+            chunk_start, chunk_length = chunk_lengths[k]
+            chunk_end = chunk_start + chunk_length
+            fragment_start, fragment_end = max(start, chunk_start), min(end, chunk_end)
+            if fragment_end > fragment_start or (length == 0 and chunk_start <= start < chunk_end):
+                fragments[k].append({"name": name, "start": fragment_start - chunk_start, "end": fragment_end - chunk_start,
+                                     "continued": start < chunk_start})
+            if end <= chunk_end: break
+            k += 1
+    return fragments
+
+def generate_chapter_map(uid, chunk_lengths, vod_name, vod_date, chapters):
+    log(f"Generating Chapter Map for VOD {uid}")
+    output = {"name": vod_name, "date": vod_date, "chunks": chapter_fragments(chunk_lengths, chapters),
+              "ranges": [[start, length] for start, length in chunk_lengths]}
     json.dump(output, open(f"vods/{uid}.map.json", "w", encoding="utf-8"))
 
+def post_text(cm):
+    return f"[{datetime.datetime.fromisoformat(cm['date']).strftime('%d.%m.%Y')}] {cm['name']}\nв комментариях 👀"
+
+def chunk_ranges(k, chunk):
+    output = f"[часть №{k}]\n"
+    for c in chunk:
+        if "end" not in c: fatal("This chapter map has no end times, regenerate it with `download` or `categorize`")
+        output += f"{pretty_time(c['start'])} - {pretty_time(c['end'])} ~ {c['name']}" + (" (продолжение)" if c["continued"] else "") + "\n"
+    return output
+
+def chunk_caption(k, chunk):
+    output = f"[часть №{k}]\n"
+    for c in chunk: output += f"{pretty_time(c['start'])} - {c['name']}\n"
+    return output
+
 def write_post(text, box):
+    import pyautogui, pyclip
     cx, cy = lerp(box.left, box.left + box.width, 0.5), \
              box.top + box.height - 20
     pyautogui.moveTo(cx, cy)
@@ -274,6 +1713,7 @@ def write_post(text, box):
     pyautogui.hotkey("ctrl", "enter")
 
 def upload_file(filepath, text, box):
+    import pyautogui, pyclip
     windows = pyautogui.getAllWindows()
     pyautogui.moveTo(box.left + 100, box.top + box.height - 10)
     pyautogui.click()
@@ -304,41 +1744,386 @@ def upload_file(filepath, text, box):
     pyautogui.hotkey("ctrl", "enter")
     time.sleep(1)
 
+def chat_capture(uid):
+    # a capture packed with `compact-chat --remove` is uploaded as is
+    for i in (f"vods/{uid}.json", f"vods/{uid}.chat"):
+        if os.path.isfile(i): return i
+    fatal(f"No chat capture of VOD {uid}, upload with --no-chat")
+
+def load_upload_config():
+    import tomllib
+    # same config as old/reply.py: [conf] apiid, apihash, chatge (channel), groupge (its discussion group)
+    if not os.path.isfile("reply-config.toml"):
+        fatal("No reply-config.toml, expected a [conf] table with apiid, apihash, chatge and groupge")
+    return tomllib.load(open("reply-config.toml", "rb"))["conf"]
+
+upload_percents = {}
+
+def upload_progress(current, total, name):
+    # transfers run concurrently, so progress is logged in 10% steps instead of redrawn in place
+    percent = current * 100 // total // 10 * 10
+    if upload_percents.get(name) != percent:
+        upload_percents[name] = percent
+        log(f"{name}: {percent}%")
+
+UPLOAD_PART_SIZE = 512 * 1024
+UPLOAD_WORKERS = 4
+UPLOAD_CHECKPOINT_PARTS = 32
+
+async def upload_api(uid, cm, post, chat, from_chunk, message, uploads):
+    # Progress is checkpointed in vods/<uid>.upload.json: acknowledged parts of every file in flight,
+    # files already uploaded to Saved Messages, and messages already posted, so a rerun just continues.
+    import pyrogram
+    from pyrogram import raw
+    from pyrogram.session import Session
+    conf = load_upload_config()
+    checkpoint_path = f"vods/{uid}.upload.json"
+    checkpoint = {"post": None, "parts": {}, "staged": {}, "posted": {}}
+    if os.path.isfile(checkpoint_path): checkpoint = json.load(open(checkpoint_path, encoding="utf-8"))
+    save_checkpoint = lambda: write_json_atomic(checkpoint_path, checkpoint)
+    gate = asyncio.Event()
+    gate.set()
+
+    async def flood_safe(call, *args, **kwargs):
+        # a FloodWait pauses every request sharing the gate, after which the same request is retried
+        while True:
+            await gate.wait()
+            try: return await call(*args, **kwargs)
+            except pyrogram.errors.FloodWait as e:
+                if not gate.is_set(): continue
+                gate.clear()
+                log(f"FloodWait, pausing all uploads for {e.value}s")
+                await asyncio.sleep(e.value)
+                gate.set()
+
+    class ResumableClient(pyrogram.Client):
+        # send_video/send_document get their file through save_file. Like pyrogram's own, this one keeps several
+        # parts in flight, on a media session for big files; it also checkpoints how many parts are acknowledged.
+        async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+            if isinstance(path, ChunkView): key, size, stamp, name = path.key, path.size, path.stamp, path.name
+            elif isinstance(path, str): key, size, stamp, name = path, os.path.getsize(path), file_stamp(path), os.path.basename(path)
+            else: return await super().save_file(path, file_id, file_part, progress, progress_args)
+            total = max(1, -(-size // UPLOAD_PART_SIZE))
+            big = size > 10 * 1024 * 1024
+            entry = checkpoint["parts"].get(key)
+            if entry is None or entry["stamp"] != stamp:
+                entry = checkpoint["parts"][key] = {"stamp": stamp, "file_id": self.rnd_id(), "acked": 0}
+            if file_id is not None: entry["acked"] = file_part # the server lost some parts, re-send from there
+            elif entry["acked"]: log(f"Resuming {progress_args[0]} from part {entry['acked']}/{total}")
+            save_checkpoint()
+
+            offset = entry["acked"] * UPLOAD_PART_SIZE
+            if entry["acked"] >= total: source = contextlib.nullcontext() # retried after the last part went through
+            elif isinstance(path, ChunkView): source = path.open(offset)
+            else:
+                source = open(path, "rb")
+                source.seek(offset)
+            jobs = UPLOAD_WORKERS if big else 1
+            queue = asyncio.Queue(jobs)
+            done, saved = set(), entry["acked"]
+
+            async def read_parts(f):
+                for part in range(entry["acked"], total):
+                    data = await asyncio.to_thread(f.read, UPLOAD_PART_SIZE)
+                    if len(data) != min(UPLOAD_PART_SIZE, size - part * UPLOAD_PART_SIZE): fatal(f"{key} changed while uploading it")
+                    await queue.put((part, data))
+                for _ in range(jobs): await queue.put(None)
+
+            async def send_parts(session):
+                nonlocal saved
+                while (item := await queue.get()) is not None:
+                    part, data = item
+                    if big: request = raw.functions.upload.SaveBigFilePart(file_id=entry["file_id"], file_part=part, file_total_parts=total, bytes=data)
+                    else: request = raw.functions.upload.SaveFilePart(file_id=entry["file_id"], file_part=part, bytes=data)
+                    await flood_safe(session.invoke, request)
+                    # only the acknowledged prefix is checkpointed, parts past a gap are sent again on resume
+                    done.add(part)
+                    while entry["acked"] in done:
+                        done.remove(entry["acked"])
+                        entry["acked"] += 1
+                    if entry["acked"] - saved >= UPLOAD_CHECKPOINT_PARTS:
+                        saved = entry["acked"]
+                        save_checkpoint()
+                    if progress: progress(min(entry["acked"] * UPLOAD_PART_SIZE, size), size, *progress_args)
+
+            session = self
+            if big and entry["acked"] < total:
+                session = Session(self, await self.storage.dc_id(), await self.storage.auth_key(), await self.storage.test_mode(), is_media=True)
+                await session.start()
+            try:
+                with source as f:
+                    tasks = [asyncio.create_task(read_parts(f))] + [asyncio.create_task(send_parts(session)) for _ in range(jobs)]
+                    try: await asyncio.gather(*tasks)
+                    finally:
+                        for i in tasks: i.cancel()
+                        await asyncio.gather(*tasks, return_exceptions=True)
+            finally:
+                if session is not self: await session.stop()
+                save_checkpoint()
+
+            if big: return raw.types.InputFileBig(id=entry["file_id"], parts=total, name=name)
+            return raw.types.InputFile(id=entry["file_id"], parts=total, name=name, md5_checksum="")
+
+    app = ResumableClient("my_account", conf["apiid"], conf["apihash"])
+    limit = asyncio.Semaphore(uploads)
+
+    async def stage(name, path, video):
+        # files are uploaded to Saved Messages in parallel, then re-sent by file id in order
+        if name in checkpoint["staged"]:
+            staged_message = await flood_safe(app.get_messages, "me", checkpoint["staged"][name])
+            if not staged_message.empty: return staged_message
+        async with limit:
+            log(f"Uploading {name}")
+            if video:
+                staged_message = await flood_safe(app.send_video, "me", path, width=1920, height=1080, supports_streaming=True,
+                                                  progress=upload_progress, progress_args=(name,))
+            else: staged_message = await flood_safe(app.send_document, "me", path, progress=upload_progress, progress_args=(name,))
+        checkpoint["parts"].pop(path.key if isinstance(path, ChunkView) else path, None)
+        checkpoint["staged"][name] = staged_message.id
+        save_checkpoint()
+        return staged_message
+
+    if message is not None and checkpoint["post"] not in (None, message):
+        checkpoint.update(post=None, staged={}, posted={})
+    async with app:
+        if checkpoint["post"] is not None and message is None:
+            message = checkpoint["post"]
+            log(f"Continuing the upload into post {message}")
+        elif post:
+            log("Sending main post")
+            message = (await flood_safe(app.send_message, conf["chatge"], post_text(cm))).id
+        elif message is None: fatal("Expected either --post or the channel post to reply to with --message ID")
+        checkpoint["post"] = message
+        save_checkpoint()
+
+        # the channel post shows up in the discussion group with a small delay
+        for _ in range(10):
+            try:
+                thread = await flood_safe(app.get_discussion_message, conf["chatge"], message)
+                break
+            except pyrogram.errors.MsgIdInvalid:
+                await asyncio.sleep(1)
+        else: fatal(f"Couldn't find the discussion thread of post {message}")
+
+        views = load_views(uid)
+        if views is not None and len(views) != len(cm["chunks"]): fatal(f"Chapter map of VOD {uid} doesn't match its chunk views, regenerate it")
+        queue = []
+        if chat: queue.append(("chat capture", chat_capture(uid), "[запись чата]", False))
+        for k, chunk in enumerate(cm["chunks"], 1):
+            source = views[k - 1] if views is not None else f"vods/{uid}/{k}.mp4"
+            if k >= from_chunk: queue.append((f"chunk #{k}", source, chunk_caption(k, chunk), True))
+        skipped = [name for name, *_ in queue if name in checkpoint["posted"]]
+        if skipped: log(f"Already posted: {', '.join(skipped)}")
+        queue = [i for i in queue if i[0] not in checkpoint["posted"]]
+        staged = [asyncio.create_task(stage(name, path, video)) for name, path, _, video in queue]
+
+        try:
+            for (name, _, caption, _), task in zip(queue, staged):
+                staged_message = await task
+                media = getattr(staged_message, staged_message.media.value)
+                sent = await flood_safe(app.send_cached_media, conf["groupge"], media.file_id, caption=caption, reply_to_message_id=thread.id)
+                checkpoint["posted"][name] = sent.id
+                del checkpoint["staged"][name]
+                save_checkpoint()
+                await flood_safe(app.delete_messages, "me", staged_message.id)
+                log(f"Posted {name}")
+        finally:
+            for task in staged: task.cancel()
+        # everything asked for is posted, so the next upload of this VOD starts from scratch
+        os.remove(checkpoint_path)
+
 def get_uid_from_clip_link(link):
     return link.split("/")[-1].split("?")[0]
 
-def download_clip(link):
-    uid = get_uid_from_clip_link(link)
-    download_clip_video(uid)
-    download_chat(uid, True)
+GQL_CLIENT_ID = "kimne78kx3ncx6brgo4mv6wki5h1ko" # public client id of the Twitch website, as in old/main.py
+
+def gql(query):
+    import urllib.request
+    request = urllib.request.Request("https://gql.twitch.tv/gql", data=json.dumps({"query": query}).encode(),
+                                     headers={"Client-ID": GQL_CLIENT_ID, "Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response: return json.load(response)
+
+def get_clip_sources(uids, batch_size=50):
+    # {clip: (VOD uid, offset in the VOD, duration)} for clips whose VOD still exists, many clips per request
+    sources = {}
+    for n in range(0, len(uids), batch_size):
+        batch = uids[n:n + batch_size]
+        query = "query {" + " ".join(f"c{k}: clip(slug: {json.dumps(uid)}) {{ durationSeconds videoOffsetSeconds video {{ id }} }}"
+                                     for k, uid in enumerate(batch)) + "}"
+        try: data = gql(query).get("data") or {}
+        except (OSError, ValueError) as e:
+            fatal_non_lethal(f"Couldn't get clip metadata from Twitch ({e}), {len(batch)} clips will be downloaded")
+            continue
+        for k, uid in enumerate(batch):
+            clip = data.get(f"c{k}")
+            if clip and clip.get("video") and clip.get("videoOffsetSeconds") is not None:
+                sources[uid] = (int(clip["video"]["id"]), clip["videoOffsetSeconds"], clip["durationSeconds"])
+    return sources
+
+def cut_clip(uid, vod, offset, duration):
+    # stream copy from the last keyframe at or before the clip start, so the clip doesn't open on a broken GOP
+    if os.path.isfile(f"clips/{uid}.mp4"):
+        log(f"Clip {uid} already downloaded, skipping")
+        return
+    _, keyframes = load_index(vod)
+    k = max(bisect.bisect_right([pts for pts, _ in keyframes], offset) - 1, 0)
+    start = keyframes[k][0]
+    log(f"Cutting clip {uid} out of VOD {vod} at {pretty_time(start)}")
+    args = ["ffmpeg", "-ss", start, "-i", f"vods/{vod}.mp4", "-t", offset - start + duration, "-c", "copy", "-map", "0",
+            "-avoid_negative_ts", "make_zero", f"clips/{uid}.part.mp4", "-y"]
+    call = cmd_silent(args, capture_output=True)
+    if call.returncode != 0:
+        fatal_non_lethal("$ " + " ".join(map(str, args)))
+        for i in call.stderr.split(b"\n"):
+            fatal_non_lethal(i.decode())
+        fatal("ffmpeg exited with non-zero exit code")
+    os.replace(f"clips/{uid}.part.mp4", f"clips/{uid}.mp4")
+
+def cut_clip_chat(uid, vod, offset, duration):
+    # the comments of the clip's time range from the VOD's capture, with offsets from the clip start
+    if os.path.isfile(f"clips/{uid}.json"):
+        log(f"Chat Capture for clip {uid} already downloaded, skipping")
+        return
+    chat = open_chat(vod)
+    def rebased():
+        for i in chat.between(offset, offset + duration):
+            comment = chat.comment(i)
+            comment["content_offset_seconds"] = round(comment["content_offset_seconds"] - offset, 3)
+            yield comment
+    write_chat(f"clips/{uid}.json", chat.head, rebased())
+    chat.close()
+
+def download_clips(clips_file, jobs):
+    # finished clips are recorded in clips/manifest.json, so reruns skip them without touching the files
+    uids = list(dict.fromkeys(get_uid_from_clip_link(i.strip()) for i in open(clips_file, encoding="utf-8") if i.strip()))
+    manifest_path = "clips/manifest.json"
+    done = set(json.load(open(manifest_path, encoding="utf-8"))) if os.path.isfile(manifest_path) else set()
+    todo = [i for i in uids if i not in done]
+    log(f"{len(uids) - len(todo)} of {len(uids)} clips already downloaded, fetching {len(todo)} with {jobs} jobs")
+
+    # clips of archived VODs are cut out of the local files, everything else is downloaded as before
+    sources = get_clip_sources(todo) if todo else {}
+    videos = {uid: source for uid, source in sources.items() if os.path.isfile(f"vods/{source[0]}.mp4")}
+    chats = {uid: source for uid, source in sources.items() if os.path.isfile(f"vods/{source[0]}.json") or os.path.isfile(f"vods/{source[0]}.chat")}
+    # indexes are built here, not by several workers at once
+    for vod in {vod for vod, *_ in videos.values()}: load_index(vod)
+    for vod in {vod for vod, *_ in chats.values()}: open_chat(vod).close()
+    if todo: log(f"{len(videos)} clips and {len(chats)} chat captures come from local VODs")
+
+    failed = set()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = {}
+        for uid in todo:
+            if uid in videos: futures[submit_traced(pool, cut_clip, uid, *videos[uid])] = uid
+            else: futures[submit_traced(pool, download_clip_video, uid)] = uid
+            if uid in chats: futures[submit_traced(pool, cut_clip_chat, uid, *chats[uid])] = uid
+            else: futures[submit_traced(pool, download_chat, uid, True)] = uid
+        pending = collections.Counter(futures.values())
+        for future in concurrent.futures.as_completed(futures):
+            uid = futures[future]
+            try: future.result()
+            except SystemExit: failed.add(uid)
+            pending[uid] -= 1
+            if pending[uid] == 0 and uid not in failed:
+                done.add(uid)
+                write_json_atomic(manifest_path, sorted(done))
+
+    if failed: fatal(f"{len(failed)} clips failed: " + ", ".join(sorted(failed)))
+
+class StageFailed(Exception):
+    # fatal() inside a stage; as a SystemExit it would escape the chat task straight through the event loop
+    pass
+
+async def download_pipeline(uid, jobs=1, net=None, local=None, chunk_size=CHUNK_SIZE, views=False, ytdlp=False, stream=False, keep_source=False):
+    # the chat capture doesn't depend on the VOD, so it is fetched and parsed while the VOD downloads and splits
+    timings = {}
+
+    async def stage(name, limit, func, *args):
+        # stages are blocking (subprocesses, file IO), so each one runs on a worker thread,
+        # optionally behind a semaphore shared with other pipelines
+        async with limit or contextlib.nullcontext():
+            start = time.perf_counter()
+            try: result = await asyncio.to_thread(in_stage, uid, name, func, *args)
+            except SystemExit: raise StageFailed(f"Stage `{name}` of VOD {uid} failed") from None
+        timings[name] = time.perf_counter() - start
+        log(f"Stage `{name}` of VOD {uid} done in {pretty_time(timings[name])}")
+        return result
+
+    async def chat_info():
+        await stage("chat", net, download_chat, uid)
+        return await stage("chat-info", local, get_cc_info, uid)
+
+    info_task = asyncio.create_task(chat_info())
+    try:
+        if stream: chunks = await stage("vod", net, stream_vod, uid, jobs, chunk_size, keep_source)
+        else:
+            await stage("vod", net, download_vod, uid, ytdlp)
+            chunks = await stage("split", local, split_vod, uid, jobs, chunk_size, views)
+        info = await info_task
+    finally:
+        if not info_task.done(): info_task.cancel()
+    await stage("map", local, generate_chapter_map, uid, chunks, info["title"], info["created_at"], [tuple(i) for i in info["chapters"]])
+
+    for name, elapsed in timings.items():
+        log(f"{name:>10}: {elapsed:.1f}s")
+
+async def download_batch(links_file, jobs, net_jobs, local_jobs, chunk_size=CHUNK_SIZE, views=False, ytdlp=False, stream=False, keep_source=False):
+    # per-VOD progress lives in <links file>.state.json, so a crashed run picks up where it stopped
+    uids = list(dict.fromkeys(parse_vod_link(i.strip()) for i in open(links_file, encoding="utf-8") if i.strip() and not i.startswith("#")))
+    state_path = links_file + ".state.json"
+    state = json.load(open(state_path, encoding="utf-8")) if os.path.isfile(state_path) else {}
+    net, local = asyncio.Semaphore(net_jobs), asyncio.Semaphore(local_jobs)
+
+    async def process(uid):
+        try:
+            await download_pipeline(uid, jobs, net, local, chunk_size, views, ytdlp, stream, keep_source)
+            state[str(uid)] = "done"
+        except (SystemExit, Exception) as e:
+            state[str(uid)] = "failed"
+            if not isinstance(e, SystemExit): fatal_non_lethal(f"{type(e).__name__}: {e}")
+            fatal_non_lethal(f"VOD {uid} failed, continuing with the rest")
+        write_json_atomic(state_path, state)
+
+    todo = [i for i in uids if state.get(str(i)) != "done"]
+    log(f"{len(uids) - len(todo)} of {len(uids)} VODs already done, processing {len(todo)}")
+    await asyncio.gather(*map(process, todo))
+
+    failed = [i for i in uids if state.get(str(i)) == "failed"]
+    if failed: fatal(f"{len(failed)} VODs failed: " + ", ".join(map(str, failed)))
 
 if __name__ == "__main__":
     makedir("vods")
+    if "--trace-summary" in sys.argv:
+        sys.argv.remove("--trace-summary")
+        atexit.register(print_trace_summary)
     operation, args = parse_args(sys.argv)
     if operation == "download":
-        uid, = args
+        uid, jobs, chunk_size, views, ytdlp, stream, keep_source = args
+
+        try: asyncio.run(download_pipeline(uid, jobs, chunk_size=chunk_size, views=views, ytdlp=ytdlp, stream=stream, keep_source=keep_source))
+        except StageFailed: sys.exit(1) # the stage has already said why
 
-        download_vod(uid)
-        download_chat(uid)
+        log("All done! Check vods/ folder.")
 
-        generate_chapter_map(uid, split_vod(uid), *get_name_date_from_cc(uid), get_chapters_from_cc(uid))
+    elif operation == "download-batch":
+        if not os.path.isfile(args[0]): fatal(f"No such file as `{args[0]}`")
+        asyncio.run(download_batch(*args))
 
         log("All done! Check vods/ folder.")
 
     elif operation == "categorize":
-        uid, = args
+        uid, jobs, chunk_size, views = args
         
         if not os.path.isfile(f"vods/{uid}.cat"):
             fatal("No such category file")
-        if not os.path.isfile(f"vods/{uid}.mp4"):
-            fatal("No such VOD file")
         
-        generate_chapter_map(uid, split_vod(uid), *get_name_date_from_cat(uid), get_chapters_from_cat(uid))
+        chunks = in_stage(uid, "split", split_vod, uid, jobs, chunk_size, views)
+        in_stage(uid, "map", generate_chapter_map, uid, chunks, *get_name_date_from_cat(uid), get_chapters_from_cat(uid))
     
         log("All done! Check vods/ folder.")
         
     elif operation == "print-chapter-map":
-        uid, = args
+        uid, ranges = args
 
         if not os.path.isfile(f"vods/{uid}.map.json"):
             fatal("No such chapter map")
@@ -346,47 +2131,85 @@ if __name__ == "__main__":
         cm = json.load(open(f"vods/{uid}.map.json", encoding="utf-8"))
         
         for k, i in enumerate(cm["chunks"], 1):
-            print(f"[часть №{k}]")
-            for c in i: print(f"{pretty_time(c['start'])} - {c['name']}")
-            print()
+            print(chunk_ranges(k, i) if ranges else chunk_caption(k, i))
 
-        print(f"[{datetime.datetime.fromisoformat(cm['date']).strftime('%d.%m.%Y')}] {cm['name']}\nв комментариях 👀")
+        print(post_text(cm))
         
     elif operation == "upload":
-        uid, post, chat, from_chunk = args
+        uid, post, chat, from_chunk, api, message, uploads = args
         if not os.path.isfile(f"vods/{uid}.map.json"):
             fatal("No such chapter map")
 
         cm = json.load(open(f"vods/{uid}.map.json", encoding="utf-8"))
 
-        log("Locating Telegram window")
+        if api:
+            asyncio.run(upload_api(uid, cm, post, chat, from_chunk, message, uploads))
+        else:
+            if os.path.isfile(f"vods/{uid}.views.json"): fatal(f"Chunks of VOD {uid} are views with no files to pick, upload them with --api")
+            import pyautogui
+            log("Locating Telegram window")
         
-        window = pyautogui.getWindowsAt(*pyautogui.position())[0].box
-        pyautogui.click()
-        
-        if post:
-            log("Sending main post and going to comments")
-            write_post(f"[{datetime.datetime.fromisoformat(cm['date']).strftime('%d.%m.%Y')}] {cm['name']}\nв комментариях 👀", window)
-            time.sleep(0.5)
-            pyautogui.moveTo(window.left + 110, window.top + window.height - 90)
+            window = pyautogui.getWindowsAt(*pyautogui.position())[0].box
             pyautogui.click()
-            time.sleep(5)
+        
+            if post:
+                log("Sending main post and going to comments")
+                write_post(post_text(cm), window)
+                time.sleep(0.5)
+                pyautogui.moveTo(window.left + 110, window.top + window.height - 90)
+                pyautogui.click()
+                time.sleep(5)
 
-        if chat:
-            log("Uploading chat capture")
-            upload_file(f"vods/{uid}.json", "[запись чата]", window)
+            if chat:
+                log("Uploading chat capture")
+                upload_file(chat_capture(uid), "[запись чата]", window)
 
-        for k, i in enumerate(cm["chunks"], 1):
-            if k < from_chunk: continue
-            log(f"Uploading chunk #{k}")
-            output = f"[часть №{k}]\n"
-            for c in i: output += f"{pretty_time(c['start'])} - {c['name']}\n"
-            upload_file(f"vods/{uid}/{k}.mp4", output, window)
+            for k, i in enumerate(cm["chunks"], 1):
+                if k < from_chunk: continue
+                log(f"Uploading chunk #{k}")
+                upload_file(f"vods/{uid}/{k}.mp4", chunk_caption(k, i), window)
+
+    elif operation == "slice-chat":
+        uid, = args
+        if not os.path.isfile(f"vods/{uid}.map.json"):
+            fatal("No such chapter map")
+
+        cm = json.load(open(f"vods/{uid}.map.json", encoding="utf-8"))
+        if "ranges" not in cm: fatal("This chapter map has no chunk ranges, regenerate it with `download` or `categorize`")
+        slice_chat(uid, cm["ranges"])
+
+    elif operation == "search-chat":
+        uid, words, start, end = args
+        ranges = []
+        if os.path.isfile(f"vods/{uid}.map.json"): ranges = json.load(open(f"vods/{uid}.map.json", encoding="utf-8")).get("ranges", [])
+        search_chat(uid, words, start, end, ranges)
+
+    elif operation == "analyze":
+        analyze_chat(*args)
+
+    elif operation == "compact-chat":
+        paths, remove = args
+        for path in paths:
+            if not os.path.isfile(path): fatal(f"No such file as `{path}`")
+            output = path.removesuffix(".json") + ".chat"
+            log(f"Compacting {path}")
+            compact_chat(path, output)
+            log(f"{path}: {pretty_bytes(os.path.getsize(path))} -> {pretty_bytes(os.path.getsize(output))}")
+            if remove:
+                verify_chat(path, output)
+                os.remove(path)
+
+    elif operation == "expand-chat":
+        paths, _ = args
+        for path in paths:
+            if not os.path.isfile(path): fatal(f"No such file as `{path}`")
+            output = path.removesuffix(".chat") + ".json"
+            if os.path.exists(output): fatal(f"`{output}` already exists")
+            log(f"Expanding {path}")
+            expand_chat(path, output)
 
     elif operation == "download-clips":
-        clips_file, = args
-        if not os.path.isfile(clips_file): error(f"No such file as `{clips_file}`")
-        clips = [i for i in open(clips_file).readlines() if i]
+        clips_file, jobs = args
+        if not os.path.isfile(clips_file): fatal(f"No such file as `{clips_file}`")
         makedir("clips")
-        for clip_link in clips:
-            download_clip(clip_link)
+        download_clips(clips_file, jobs)
@@ -0,0 +1,70 @@
+import random
+import pytest
+import main
+
+# Property checks of chapter_fragments on random chunk and chapter tables, with boundaries on
+# 1, 5 and 50 second grids so that chapter and chunk boundaries often coincide.
+
+def cursor_chapter_map(chunk_lengths, chapters):
+    # the chunk walk generate_chapter_map used before chapter_fragments, kept as the reference
+    output = []
+    chapter, chapter_start, chapter_offset = 0, 0, 0
+    for chunk_start, chunk_length in chunk_lengths:
+        chunk = []
+        chunk_end = chunk_start + chunk_length
+        while chapter_start + chapter_offset < chunk_end:
+            if chapter >= len(chapters): break
+            chapter_name, chapter_start, chapter_length = chapters[chapter]
+            chunk.append({"name": chapter_name, "start": chapter_start + chapter_offset - chunk_start})
+            if chapter_start + chapter_length > chunk_end:
+                chapter_offset += chunk_start + chunk_length - chapter_start - chapter_offset
+            else:
+                chapter += 1
+                chapter_offset = 0
+        output.append(chunk)
+    return output
+
+def random_table(rng, total, count, step):
+    # `count` back to back spans covering [0, total), cut on a grid of `step`
+    grid = range(step, total, step)
+    cuts = sorted(rng.sample(grid, min(count - 1, len(grid))))
+    bounds = [0, *cuts, total]
+    return [(a, b - a) for a, b in zip(bounds, bounds[1:])]
+
+def random_tables(seed, gaps=False):
+    rng = random.Random(seed)
+    total = rng.randrange(2, 2000)
+    chunks = random_table(rng, total, rng.randrange(1, 12), rng.choice((1, 5, 50)))
+    chapters = [(f"chapter {i}", start, length) for i, (start, length) in enumerate(random_table(rng, total, rng.randrange(1, 40), rng.choice((1, 5, 50))))]
+    if gaps: chapters = [i for i in chapters if rng.random() < 0.7] or chapters[:1]
+    return chunks, chapters
+
+@pytest.mark.parametrize("seed", range(2000))
+def test_matches_cursor_walk(seed):
+    # The one intended difference: the walk also emitted an empty fragment, at the very end of
+    # a chunk, for a chapter starting exactly on the boundary to the next one.
+    chunks, chapters = random_tables(seed)
+    expected = [[(c["name"], c["start"]) for c in chunk if c["start"] < length]
+                for chunk, (_, length) in zip(cursor_chapter_map(chunks, chapters), chunks)]
+    assert [[(c["name"], c["start"]) for c in chunk] for chunk in main.chapter_fragments(chunks, chapters)] == expected
+
+@pytest.mark.parametrize("seed", range(2000))
+@pytest.mark.parametrize("gaps", [False, True])
+def test_fragments_tile_chapters(seed, gaps):
+    chunks, chapters = random_tables(seed, gaps)
+    fragments = main.chapter_fragments(chunks, chapters)
+    assert len(fragments) == len(chunks)
+    pieces = {}
+    for (chunk_start, chunk_length), chunk in zip(chunks, fragments):
+        for c in chunk:
+            assert 0 <= c["start"] < c["end"] <= chunk_length
+            chapter_start = next(start for name, start, _ in chapters if name == c["name"])
+            assert c["continued"] == (chapter_start < chunk_start)
+            pieces.setdefault(c["name"], []).append((chunk_start + c["start"], chunk_start + c["end"]))
+
+    total = sum(length for _, length in chunks)
+    for name, start, length in chapters:
+        # every chapter is covered exactly, in order, by its fragments, up to the end of the last chunk
+        assert pieces[name][0][0] == start
+        assert all(a[1] == b[0] for a, b in zip(pieces[name], pieces[name][1:]))
+        assert pieces[name][-1][1] == min(start + length, total)